@@ -40,6 +40,17 @@ def get_args():
     parser.add_argument('--force', '-f', action='store_true',
                         help='if the given new character history directory already exists, '
                              'delete it, and recreate it with the new character history')
+    parser.add_argument('--hardlink', action='store_true',
+                        help='hardlink history files in which nothing changed into the output directory rather than '
+                             'copying them')
+    parser.add_argument('--lazy', action='store_true',
+                        help='only fully parse characters whose dynasty is named by a rule; copy all others verbatim')
+    parser.add_argument('--parse-cache', metavar='DIR',
+                        help='cache parsed history files in DIR, and load any which are unchanged since from there '
+                             '(implies no --lazy)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes for parsing & rewriting history files [default: '
+                             '%(default)s]')
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help='show verbose information about what the script is doing;'
                              'repeat this option multiple times for more details')
@@ -81,7 +92,7 @@ def transform(rules, ch, melt_date):
             if new_cul != c.culture.val:
                 stats_n_chars_melted += 1
                 #print('  Character{{ Name: "{}" / ID: {} }}'.format(c.name.val, c.id))
-                c.culture = history.CommentableVal(new_cul, '# melted from: ' + c.culture.val)
+                ch.set_culture(c, history.CommentableVal(new_cul, '# melted from: ' + c.culture.val))
                 c.dirty = True
 
     return cultures_melted
@@ -123,12 +134,14 @@ def main():
         # Create a new output directory
         os.makedirs(args.output_history_dir)
 
-        char_hist = history.CharHistory(sys.stdout, args.verbose)
-        char_hist.parse_dir(args.history_dir)  # Parse entire character history folder
+        lazy_dynasties = set(r.dyn_id for r in melt_rules) if args.lazy else None
+        char_hist = history.CharHistory(sys.stdout, args.verbose, lazy_dynasties, args.parse_cache)
+        char_hist.parse_dir(args.history_dir, args.jobs)  # Parse entire character history folder
 
         cul_melted = transform(melt_rules, char_hist, melt_date)
 
-        char_hist.rewrite(args.output_history_dir)  # Fully rewrite the history folder from parse trace in RAM
+        # Rewrite the files with melted characters from the parse trace in RAM, pass the rest through
+        (n_files_rewritten, n_files_passed) = char_hist.rewrite(args.output_history_dir, args.jobs, args.hardlink)
 
         if len(cul_melted) > 0:
             print('Rule-affected cultures (does not imply rule had effects):')
@@ -140,6 +153,12 @@ def main():
 
         print('Characters theoretically affected: {}'.format(stats_n_chars_affected))
         print('Characters actually rewritten: {}'.format(stats_n_chars_melted))
+        if args.lazy and not args.parse_cache:
+            print('Characters left unparsed (lazy): {}'.format(len(char_hist.lazy_ids)))
+        if args.parse_cache:
+            print('Parse cache: {} hits, {} misses'.format(char_hist.cache_hits, char_hist.cache_misses))
+        print('History files rewritten: {}'.format(n_files_rewritten))
+        print('History files passed through: {}'.format(n_files_passed))
 
         return 0
 
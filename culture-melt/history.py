@@ -1,14 +1,22 @@
 __author__ = 'zijistark'
 
 import os
+import shutil
 import codecs
 import re
+import bisect
+import mmap
+import marshal
+import hashlib
+import itertools
+import multiprocessing
+import StringIO
 
 INDENT_UNIT = '\t'
+CACHE_FORMAT = 2  # Bump whenever the parse cache's summary layout changes (see CHFileChar.summarize)
 
 p_txt_file = re.compile(r'^.*?\.txt$')
 p_opt_quoted = re.compile(r'^(?:"([^"]+)"|([^"\s]+))$')
-p_blank = re.compile(r'^\s+$')
 p_bare_comment_or_blank = re.compile(r'^(\s*#.*)|(\s*)$')
 p_char_start = re.compile(r'^\s*(\d+)\s*=\s*\{\s*(#.*)?$')
 p_char_end = re.compile(r'^\}\s*$')
@@ -20,14 +28,17 @@ p_char_dynasty = re.compile(r'^\s*dynasty\s*=\s*(?:"(\d+)"|(\d+))\s*(#.*)?$')
 p_char_hist_entry_start = re.compile(r'^\s*(\d{1,4})\.(\d{1,2})\.(\d{1,2})\s*=\s*\{')  # NOTE: Captures no comment
 p_char_hist_entry_multi_start = re.compile(r'^\s*(\d{1,4})\.(\d{1,2})\.(\d{1,2})\s*=\s*$')
 p_char_hist_entry_multi_finish = re.compile(r'^\s*\{\s*$')
-p_char_hist_entry_birth = re.compile(r'^\s*birth\s*=\s*(?:"(?:[^"]+)"|([^"\s]+))')  # NOTE: Captures no comment
-p_open_brace = re.compile(r'^([^}]*)\{')
-p_close_brace = re.compile(r'^([^{]*)\}')
+p_char_hist_entry_birth = re.compile(r'\s*birth\s*=\s*(?:"(?:[^"]+)"|([^"\s]+))')  # NOTE: Captures no comment; no ^ as
+#  it's used with pattern.match(buf, pos)
+p_open_brace = re.compile(r'([^}]*)\{')  # NOTE: Greedy, so a run of opening braces uninterrupted by a closing brace
+p_close_brace = re.compile(r'([^{]*)\}')  # counts as one (and vice versa); no ^ as these are used with match(buf, pos)
+p_line_key = re.compile(r'\s*(\w*)')  # Leading key of a line within a character block, by which the line is classified
 p_one_line_one_block = re.compile(r'^\s*[^#]*\{.*\}')  # Used to detect an unsupported parse case for top-level char
 #  blocks
 
 class CHParseError(Exception):
     def __init__(self, msg):
+        Exception.__init__(self, msg)  # Sets self.args, so that worker processes can pickle it back to us
         self.msg = msg
 
     def __str__(self):
@@ -53,6 +64,21 @@ class CHFileLiteralPart:  # Identical but without an implied EOL
             f.write(self.literal)
 
 
+# Untouched source text, kept only as a [start, end) byte range of the original file (cp1252 is single-byte, so these
+# are also offsets into the decoded text). Written straight from the mmap'd source with the same CRLF/CR->LF conversion
+# which rewriting it line-by-line would do.
+class CHFileSpan:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def rewrite(self, f, src):
+        data = src[self.start:self.end]
+        if '\r' in data:
+            data = data.replace('\r\n', '\n').replace('\r', '\n')
+        f.stream.write(data)  # Already cp1252, so bypass the codec
+
+
 class DateVal:  # Assumes string values in constructor
     def __init__(self, y, m, d):
         self.y = int(y)
@@ -88,15 +114,16 @@ class CHFileCharHistEntry:
         for e in self.elems:
             e.rewrite(f)
 
-    def parse(self, ch, chfc, f, n_line):
+    def parse(self, ch, chfc, lines, n_line):
         buf = ''
         buf_idx = 0  # Index into buf for current parsing position
+        buf_end = 0  # Index into buf past which there's only whitespace
         nest_level = 1  # Already started the history entry, so we're already nested by 1 level
         birth = False  # Have we seen a birth history effect in this entry?
 
         while nest_level > 0:
-            if len(buf) == buf_idx:  # Parsing has reached the end of our useful buffered input
-                buf = f.readline()
+            if buf_idx >= buf_end:  # Parsing has reached the end of our useful buffered input
+                buf = next(lines, u'')
                 if len(buf) == 0:  # EOF
                     raise CHParseError("Unexpected EOF while parsing character ID %d [%s: line %d]!" % (chfc.id,
                                                                                                         g_filename,
@@ -104,16 +131,15 @@ class CHFileCharHistEntry:
                 n_line += 1
                 buf_idx = 0  # Reset index to beginning of new line
                 buf = buf.rstrip(u'\r\n')
-
-                chfc.literal_elems.append(CHFileLiteral(buf))  # Make a literal copy for our dirty-marking mechanism
+                buf_end = len(buf.rstrip(u' \t\n\r\f\v'))  # Exactly regex \s, unlike a bare rstrip() on unicode
 
                 continue  # Hopefully that gave us something with which to work, try again.
 
-            # buf is nonempty, buf[buf_idx:] is also nonempty, so we still having matching/consumption to do.
+            # buf is nonempty, buf[buf_idx:] is also nonblank, so we still having matching/consumption to do.
 
             # Look for a birth statement at nest_level == 1 in case this history entry includes/is a birth date
             if nest_level == 1:
-                m = p_char_hist_entry_birth.match(buf[buf_idx:])
+                m = p_char_hist_entry_birth.match(buf, buf_idx)
                 if m:
                     if birth:
                         raise CHParseError("Multiple birth-date history effects for character ID %d [%s: line %d]!"
@@ -127,30 +153,29 @@ class CHFileCharHistEntry:
                     continue
 
             # Look for a starting brace to increment the nest level, capture interim literal data
-            m = p_open_brace.match(buf[buf_idx:])
+            m = p_open_brace.match(buf, buf_idx)
             if m:
                 nest_level += 1
-                buf_idx += m.end()
-                if buf_idx < len(buf) and not p_blank.match(buf[buf_idx:]):  # Oh, but there's MORE!
+                buf_idx = m.end()
+                if buf_idx < buf_end:  # Oh, but there's MORE!
                     self.elems.append(CHFileLiteralPart(m.group()))
                 else:
                     self.elems.append(CHFileLiteral(m.group()))
                 continue
 
             # Look for a closing brace to decrement the nest level, capture interim literal data
-            m = p_close_brace.match(buf[buf_idx:])
+            m = p_close_brace.match(buf, buf_idx)
             if m:
                 nest_level -= 1
-                buf_idx += m.end()
-                if buf_idx < len(buf) and not p_blank.match(buf[buf_idx:]):  # Oh, but there's YET MORE!
+                buf_idx = m.end()
+                if buf_idx < buf_end:  # Oh, but there's YET MORE!
                     self.elems.append(CHFileLiteralPart(m.group()))
                 else:
                     self.elems.append(CHFileLiteral(m.group()))
                 continue
 
             # Else, it's just literal data/effects, so capture all the remainder (no change in brace nesting)
-            if not p_blank.match(buf[buf_idx:]):
-                self.elems.append(CHFileLiteral(buf[buf_idx:]))
+            self.elems.append(CHFileLiteral(buf[buf_idx:]))
             buf_idx = len(buf)  # One past end, fully consumed
 
 
@@ -170,7 +195,7 @@ class CHFileChar:
         self.start_line = -1
         self.hist_entries = []
         self.elems = []
-        self.literal_elems = []  # Original string rep. of each line of the character, used for output when !self.dirty
+        self.span = None  # Source span of the whole character definition, used for output when !self.dirty
         self.dirty = False  # Has the object been modified by a transform rule? Used to minimize text diff on rewrite.
         self.is_last_in_file = False
         self.female = None
@@ -187,11 +212,46 @@ class CHFileChar:
             raise CHParseError('Character ID %d [%s: line %d] has no birth date defined!'
                                % (self.id, g_filename, self.start_line))
 
-    def rewrite(self, f):  # Must be called post object-finalization (which happens immediately after successful parse)
-
-        self.start_line_literal.rewrite(f) # Don't fuzzy up the diff with simple whitespace changes and the like
+    # Compact form of the character for the parse cache: its fields and source span only (marshal-able builtins), as
+    # its structured elements can be rebuilt from the source by reparse() whenever they're needed.
+    def summarize(self):
+        rel = getattr(self, 'religion', CommentableVal(None))
+        return (self.id, self.comment, self.start_line_literal.literal, self.start_line, self.span.start, self.span.end,
+                self.is_last_in_file, self.female, self.name.val, self.name.cmt, self.dynasty.val, self.dynasty.cmt,
+                rel.val, rel.cmt, self.culture.val, self.culture.cmt, self.bdate.y, self.bdate.m, self.bdate.d)
+
+    @staticmethod
+    def from_summary(t):
+        c = CHFileChar(t[0], t[2], t[1])
+        c.start_line = t[3]
+        c.span = CHFileSpan(t[4], t[5])
+        c.is_last_in_file = t[6]
+        c.female = t[7]
+        c.name = CommentableVal(t[8], t[9])
+        c.dynasty = CommentableVal(t[10], t[11])
+        if t[12] is not None:
+            c.religion = CommentableVal(t[12], t[13])
+        c.culture = CommentableVal(t[14], t[15])
+        c.bdate = DateVal(t[16], t[17], t[18])
+        c.hist_entries = None  # Not yet rebuilt from the source
+        c.elems = None
+        return c
+
+    def reparse(self, src):  # Rebuild the structured elements of a character loaded from the parse cache
+        text_lines = src[self.span.start:self.span.end].decode('cp1252').splitlines(True)
+        c = CHFileChar(self.id, text_lines[0].rstrip(u'\r\n'), self.comment)
+        c.parse(CharHistory(), iter(text_lines[1:]), self.start_line)
+        self.hist_entries = c.hist_entries
+        self.elems = c.elems
+
+    def rewrite(self, f, src):  # Must be called post object-finalization (which happens right after successful parse)
 
         if self.dirty:
+            if self.elems is None:
+                self.reparse(src)
+
+            self.start_line_literal.rewrite(f) # Don't fuzzy up the diff with simple whitespace changes and the like
+
             if self.name.cmt is None:
                 f.write(u'\tname="{}"\n'.format(self.name.val))
             else:
@@ -221,17 +281,15 @@ class CHFileChar:
                 f.write(u'}\n')
         else:
             # Straight-up copy of the character definition block, only possible difference being CRLF->LF conversion
-            # and [currently-- I might disable it] stripping of any unnecessary trailing whitespace on lines.
-            for e in self.literal_elems:
-                e.rewrite(f)
+            self.span.rewrite(f, src)
 
-    def parse(self, ch, f, n_line):
+    def parse(self, ch, lines, n_line):
         self.start_line = n_line
         histent_brace_wait = False
 
         ch.log_dbg("Parsing character ID %d [%s:L%d] ..." % (self.id, g_filename, n_line))
         while True:
-            line = f.readline()
+            line = next(lines, u'')
             if len(line) == 0:  # EOF
                 raise CHParseError("Unexpected EOF while parsing character ID %d [%s: line %d]!" % (self.id,
                                                                                                     g_filename,
@@ -240,18 +298,9 @@ class CHFileChar:
             line_had_eol = line.endswith((u'\n', u'\r'))
             line = line.rstrip(u'\r\n')
 
-            # Always make an exact copy of the original line (minus the whitespace/EOL normalization above) of the
-            # line in the likely case that we never modify this character object and thus can trivially do its rewrite
-            # with a zero text diff.
-            if line_had_eol:
-                self.literal_elems.append(CHFileLiteral(line))
-            else:
-                self.literal_elems.append(CHFileLiteralPart(line))
-
             # Proactively catch this rare unsupported syntax case (only applies to top-level of character history
             # definitions, obviously not the arbitrarily-complex brace matching in history entries).
-            m = p_one_line_one_block.match(line)
-            if m:
+            if u'}' in line and p_one_line_one_block.match(line):
                 raise CHParseError("Oops! Call ziji! You've hit upon a rare syntax style unsupported in the history "
                                    "parser in %s: line %d" % (g_filename, n_line))
 
@@ -263,76 +312,80 @@ class CHFileChar:
                 # Haaaackin' away...
                 h_ent = CHFileCharHistEntry(d)
                 self.hist_entries.append(h_ent)
-                (n_line, is_birth) = h_ent.parse(ch, self, f, n_line)
+                (n_line, is_birth) = h_ent.parse(ch, self, lines, n_line)
                 if is_birth:
                     self.bdate = d
                 del d  # (Want Python to throw a NameError if state mismatch)
                 histent_brace_wait = False
                 continue
 
-            m = p_char_name.match(line)
-            if m:
-                self.name = dequoteCommentableVal(m)
-                continue
+            # Classify the line by its leading key (or date) so that at most the one or two patterns that could possibly
+            # match it are tried.
+            key = p_line_key.match(line).group(1)
 
-            m = p_char_female.match(line)
-            if m and m.group(1) == u'yes':
-                self.female = True
-                continue
-                
-            m = p_char_dynasty.match(line)
-            if m:
-                self.dynasty = dequoteCommentableVal(m)
-                self.dynasty.val = int(self.dynasty.val)
-                continue
-                
-            m = p_char_religion.match(line)
-            if m:
-                self.religion = dequoteCommentableVal(m)
-                continue
-                
-            m = p_char_culture.match(line)
-            if m:
-                self.culture = dequoteCommentableVal(m)
-                continue
+            if key == u'name':
+                m = p_char_name.match(line)
+                if m:
+                    self.name = dequoteCommentableVal(m)
+                    continue
 
+            elif key == u'female':
+                m = p_char_female.match(line)
+                if m and m.group(1) == u'yes':
+                    self.female = True
+                    continue
 
-            m = p_char_hist_entry_start.match(line)
-            if m:
-                d = DateVal(m.group(1), m.group(2), m.group(3))
-                h_ent = CHFileCharHistEntry(d)
-                self.hist_entries.append(h_ent)
-                (n_line, is_birth) = h_ent.parse(ch, self, f, n_line)
-                if is_birth:
-                    self.bdate = d
-                continue
+            elif key == u'dynasty':
+                m = p_char_dynasty.match(line)
+                if m:
+                    self.dynasty = dequoteCommentableVal(m)
+                    self.dynasty.val = int(self.dynasty.val)
+                    continue
 
-            m = p_char_hist_entry_multi_start.match(line)
-            if m:
-                d = DateVal(m.group(1), m.group(2), m.group(3))  # Save in function scope for completion state
-                histent_brace_wait = True
-                continue
+            elif key == u'religion':
+                m = p_char_religion.match(line)
+                if m:
+                    self.religion = dequoteCommentableVal(m)
+                    continue
 
-            m = p_char_end.match(line)
-            if m:
-                if not line_had_eol:
-                    self.is_last_in_file = True
-                self._finalize()
+            elif key == u'culture':
+                m = p_char_culture.match(line)
+                if m:
+                    self.culture = dequoteCommentableVal(m)
+                    continue
 
-                # Index
-                ch.chars[self.id] = self
+            elif key[:1].isdigit():
+                m = p_char_hist_entry_start.match(line)
+                if m:
+                    d = DateVal(m.group(1), m.group(2), m.group(3))
+                    h_ent = CHFileCharHistEntry(d)
+                    self.hist_entries.append(h_ent)
+                    (n_line, is_birth) = h_ent.parse(ch, self, lines, n_line)
+                    if is_birth:
+                        self.bdate = d
+                    continue
 
-                if self.dynasty.val in ch.chars_by_dynasty:
-                    ch.chars_by_dynasty[self.dynasty.val].append(self)
-                else:
-                    ch.chars_by_dynasty[self.dynasty.val] = [ self ]
+                m = p_char_hist_entry_multi_start.match(line)
+                if m:
+                    d = DateVal(m.group(1), m.group(2), m.group(3))  # Save in function scope for completion state
+                    histent_brace_wait = True
+                    continue
 
-                ch.log_dbg(str(self.id) + " {\n"
-                           + ' dynasty  => ' + str(self.dynasty.val) + "\n"
-                           + ' culture  => ' + str(self.culture.val) + "\n"
-                           + ' birthday => ' + str(self.bdate) + "\n"
-                           + "}\n")
-                return n_line
+            elif not key:
+                m = p_char_end.match(line)
+                if m:
+                    if not line_had_eol:
+                        self.is_last_in_file = True
+                    self._finalize()
+
+                    ch.index_char(self)
+
+                    ch.log_dbg(str(self.id) + " {\n"
+                               + ' dynasty  => ' + str(self.dynasty.val) + "\n"
+                               + ' culture  => ' + str(self.culture.val) + "\n"
+                               + ' birthday => ' + str(self.bdate) + "\n"
+                               + "}\n")
+                    return n_line
 
             # Upon no match, record the line as literal data (we don't support all possible character history
             # definition elements, esp. not Paradox scripting history effects, but we record them in-place so that we
@@ -340,6 +393,25 @@ class CHFileChar:
             self.elems.append(CHFileLiteral(line))
 
 
+# Lazy mode's pre-scan of a character block whose start line is text_lines[i-1]: finds the block's closing line and any
+# dynasty lines within it, without parsing anything else. Returns the (1-based) line number of the closing line if the
+# character can't belong to any of the given dynasties, or None if it must be fully parsed. This errs on the side of a
+# full parse: a dynasty line anywhere in the block counts, a lowborn (dynasty 0) rule means every character counts, and
+# a block with no closing line is left to the full parser to report.
+def prescan_char(text_lines, i, dynasties):
+    if 0 in dynasties:
+        return None
+    for j in xrange(i, len(text_lines)):
+        line = text_lines[j]
+        if line[:1] == u'}' and p_char_end.match(line.rstrip(u'\r\n')):
+            return j + 1
+        if u'dynasty' in line:
+            m = p_char_dynasty.match(line.rstrip(u'\r\n'))
+            if m and int(m.group(1) or m.group(2)) in dynasties:
+                return None
+    return None
+
+
 class CHFile:
     def __init__(self, ch, filename, path):
         assert os.path.isfile(path)
@@ -347,15 +419,70 @@ class CHFile:
         self.filename = filename
         self.path = path
         self.elems = []
+        self.src_stat = None  # (size, mtime) of the source file as parsed, as our spans refer into it
+        self.src_sha1 = None  # SHA-1 of the source file as parsed, for the parse cache
+        self.lazy_ids = []  # (line, ID) of characters which lazy mode didn't parse
+
+    def summarize(self):
+        return [e.summarize() if isinstance(e, CHFileChar) else (e.start, e.end) for e in self.elems]
+
+    def load_summary(self, summary, src_stat, src_sha1):
+        self.src_stat = src_stat
+        self.src_sha1 = src_sha1
+        for t in summary:
+            self.elems.append(CHFileChar.from_summary(t) if len(t) > 2 else CHFileSpan(t[0], t[1]))
+
+    def is_dirty(self):
+        for e in self.elems:
+            if isinstance(e, CHFileChar) and e.dirty:
+                return True
+        return False
+
+    def check_src_stat(self, st):
+        if (st.st_size, st.st_mtime) != self.src_stat:
+            raise CHParseError("History file '%s' has changed since it was parsed!" % self.filename)
 
     def rewrite(self, basedir):
+        self.ch.log_info("Rewriting '%s' ..." % self.filename)
+        self.write(os.path.join(basedir, self.filename))
+
+    def pass_through(self, basedir, link=False):  # Output a file with no dirty characters as-is, byte-for-byte
+        self.ch.log_info("Passing through '%s' ..." % self.filename)
         path = os.path.join(basedir, self.filename)
         assert not os.path.exists(path)
 
-        self.ch.log_info("Rewriting '%s' ..." % self.filename)
-        with codecs.open(path, mode='wb', encoding='cp1252') as f:
-            for e in self.elems:
-                e.rewrite(f)
+        self.check_src_stat(os.stat(self.path))
+        if link and hasattr(os, 'link'):
+            try:
+                os.link(self.path, path)
+                return
+            except OSError:  # E.g., output on another filesystem
+                pass
+        shutil.copyfile(self.path, path)
+
+    def write(self, path):
+        global g_filename
+        g_filename = self.filename  # For any error messages from reparse()
+        assert not os.path.exists(path)
+
+        with open(self.path, 'rb') as fsrc:
+            st = os.fstat(fsrc.fileno())
+            self.check_src_stat(st)
+            src = mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size > 0 else ''  # Can't map 0 bytes
+            try:
+                with open(path, 'wb') as fout:
+                    f = codecs.getwriter('cp1252')(fout)
+                    for e in self.elems:
+                        e.rewrite(f, src)
+            finally:
+                if st.st_size > 0:
+                    src.close()
+
+    def add_span(self, start, end):
+        if self.elems and isinstance(self.elems[-1], CHFileSpan) and self.elems[-1].end == start:
+            self.elems[-1].end = end  # Coalesce runs of untouched text into one span
+        else:
+            self.elems.append(CHFileSpan(start, end))
 
     def parse(self):
         global g_filename
@@ -363,13 +490,22 @@ class CHFile:
         n_line = 0
 
         self.ch.log_info("Parsing '%s' ..." % self.filename)
-        with codecs.open(self.path, mode='rb', encoding='cp1252') as f:
-            while True:
-                line = f.readline()
-                if len(line) == 0:  # EOF
-                    break
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.src_stat = (st.st_size, st.st_mtime)
+            data = f.read()
+            self.src_sha1 = hashlib.sha1(data).hexdigest()
+
+            # Same lines as readline() would give, but split in one pass. The char parsers consume this iterator too.
+            text_lines = data.decode('cp1252').splitlines(True)
+            del data
+            end = 0  # Source offset of the end of line n_line
+
+            lines = iter(text_lines)
+            for line in lines:
                 n_line += 1
-                line_had_eol = line.endswith((u'\n', u'\r'))
+                start = end
+                end += len(line)
                 line = line.rstrip(u'\r\n')
 
                 m = p_char_start.match(line)
@@ -381,20 +517,31 @@ class CHFile:
 
                     id = int(m.group(1))
 
-                    if id in self.ch.chars:
+                    if id in self.ch.chars or id in self.ch.lazy_ids:
                         raise CHParseError("Duplicate character ID found at %s: line %d!" % (g_filename, n_line))
 
+                    if self.ch.lazy_dynasties is not None:
+                        end_line = prescan_char(text_lines, n_line, self.ch.lazy_dynasties)
+                        if end_line is not None:  # Irrelevant to the rules, so just copy it verbatim on rewrite
+                            next(itertools.islice(lines, end_line - n_line - 1, None))  # Skip past its closing line
+                            self.ch.lazy_ids.add(id)
+                            self.lazy_ids.append((n_line, id))
+                            end += sum(map(len, text_lines[n_line:end_line]))
+                            self.add_span(start, end)
+                            n_line = end_line
+                            continue
+
                     c = CHFileChar(id, line, comment)
-                    n_line = c.parse(self.ch, f, n_line)
+                    start_line = n_line
+                    n_line = c.parse(self.ch, lines, n_line)
+                    end += sum(map(len, text_lines[start_line:n_line]))
+                    c.span = CHFileSpan(start, end)
                     self.elems.append(c)
                     continue
 
                 m = p_bare_comment_or_blank.match(line)
                 if m:  # Literal data, should be kept in-place on rewrite if possible
-                    if line_had_eol:
-                        self.elems.append(CHFileLiteral(line))
-                    else:
-                        self.elems.append(CHFileLiteralPart(line))
+                    self.add_span(start, end)
                     continue
 
                 # Or else...
@@ -410,14 +557,84 @@ class CHFile:
         #     if isinstance(last_elem, CHFileChar):
         #         last_elem.is_last_in_file = True
 
+
+# With jobs > 1, history files are parsed in a pool of worker processes (the parser is pure-Python regex work, so
+# threads wouldn't help). Each worker parses a file into a private CharHistory, logging into a buffer, and sends back
+# the CHFile and its log; results come back in submission order, so that logs & errors match a serial run.
+#
+# The caller owns the TaskPool and must stop() it in a finally clause. Pool.terminate() isn't safe for that: it can
+# deadlock against a worker which is still sending a (large) result, so stop() rather has any queued tasks skipped and
+# then lets the workers drain and exit, whether or not an error was raised by a worker or while consuming results.
+class TaskPool:
+    def __init__(self, jobs):
+        self.pool = None
+        if jobs > 1:
+            self.abort = multiprocessing.Event()
+            self.pool = multiprocessing.Pool(jobs, init_worker, (self.abort,))
+
+    def run(self, func, tasks):  # -> iterator over the results, in task order
+        if self.pool is None:
+            return itertools.imap(func, tasks)
+        return self.pool.imap(run_worker_task, [(func, task) for task in tasks])
+
+    def stop(self):
+        if self.pool is not None:
+            self.abort.set()
+            self.pool.close()
+            self.pool.join()
+
+
+def init_worker(abort):
+    global g_abort
+    g_abort = abort
+
+
+def run_worker_task(task):
+    func, task = task
+    return None if g_abort.is_set() else func(task)
+
+
+def parse_task(task):
+    filename, path, log_verbosity, lazy_dynasties = task
+    log_file = StringIO.StringIO()
+    chf = CHFile(CharHistory(log_file, log_verbosity, lazy_dynasties), filename, path)
+    chf.parse()
+    chf.ch = None  # Don't ship the worker's whole index back along with the file
+    return chf, log_file.getvalue()
+
+
+# Rewriting only needs the parsed files, which are far more expensive to pickle over to a worker than to just write out,
+# so workers are forked with them already in memory (g_rewrite_files) and receive only filenames. Where there's no
+# fork() (Windows), rewriting stays serial.
+def rewrite_task(task):
+    filename, out_dir = task
+    g_rewrite_files[filename].write(os.path.join(out_dir, filename))
+    return filename
+
+
 class CharHistory:
-    def __init__(self, log_file=None, log_verbosity=0):
+    # With lazy_dynasties (a set of dynasty IDs), only characters which may belong to one of those dynasties are parsed;
+    # the rest are merely pre-scanned, copied verbatim upon rewrite, and absent from chars & all of the other indexes.
+    #
+    # With cache_dir, parsed files are summarized into a parse cache there, and later loaded from it while unchanged
+    # (see load_cached). Only complete parses can be cached, so lazy_dynasties is then ignored.
+    def __init__(self, log_file=None, log_verbosity=0, lazy_dynasties=None, cache_dir=None):
         assert(log_verbosity == 0 or log_file is not None)
         self.log_file = log_file
         self.log_verbosity = log_verbosity
+        self.lazy_dynasties = lazy_dynasties if cache_dir is None else None
+        self.cache_dir = cache_dir
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.files = {}  # Parsed character history files, indexed by base filename
         self.chars = {}  # Objects indexed by ID
         self.chars_by_dynasty = {}  # Object list indexed by dynasty ID
+        self.chars_by_culture = {}  # ID set indexed by culture; culture changes must go through set_culture()
+        self.chars_by_religion = {}  # ID set indexed by religion (None where undefined)
+        self.chars_by_female = {False: set(), True: set()}  # ID set indexed by whether female
+        self.chars_by_bdate = []  # (Canonical birth date, ID) pairs, sorted upon the first query after any additions
+        self.chars_by_bdate_sorted = True
+        self.lazy_ids = set()  # IDs of the characters which lazy mode didn't parse
 
     def log_print(self, msg, level):
         if self.log_verbosity >= level:
@@ -433,25 +650,184 @@ class CharHistory:
     def log_info(self, msg):
         self.log_print(msg, 1)
 
+    def index_char(self, c):
+        self.chars[c.id] = c
+
+        if c.dynasty.val in self.chars_by_dynasty:
+            self.chars_by_dynasty[c.dynasty.val].append(c)
+        else:
+            self.chars_by_dynasty[c.dynasty.val] = [ c ]
+
+        self.chars_by_culture.setdefault(c.culture.val, set()).add(c.id)
+        self.chars_by_religion.setdefault(getattr(c, 'religion', CommentableVal(None)).val, set()).add(c.id)
+        self.chars_by_female[bool(c.female)].add(c.id)
+        self.chars_by_bdate.append((c.bdate.c, c.id))
+        self.chars_by_bdate_sorted = False
+
+    def set_culture(self, c, culture):  # culture is a CommentableVal
+        if culture.val != c.culture.val:
+            ids = self.chars_by_culture[c.culture.val]
+            ids.discard(c.id)
+            if not ids:
+                del self.chars_by_culture[c.culture.val]
+            self.chars_by_culture.setdefault(culture.val, set()).add(c.id)
+        c.culture = culture
+
+    # Returns the characters matching all of the given criteria (those which aren't None), sorted by ID. Birth dates are
+    # DateVal, born_from inclusive and born_before exclusive. Candidates come from the most selective of the applicable
+    # indexes and are intersected with the others, so cost is proportional to the matches rather than to all characters.
+    def query(self, culture=None, religion=None, female=None, born_from=None, born_before=None):
+        candidates = []
+        if culture is not None:
+            candidates.append(self.chars_by_culture.get(culture, set()))
+        if religion is not None:
+            candidates.append(self.chars_by_religion.get(religion, set()))
+        if female is not None:
+            candidates.append(self.chars_by_female[bool(female)])
+
+        by_date = born_from is not None or born_before is not None
+        if by_date:
+            if not self.chars_by_bdate_sorted:
+                self.chars_by_bdate.sort()
+                self.chars_by_bdate_sorted = True
+            lo = 0 if born_from is None else bisect.bisect_left(self.chars_by_bdate, (born_from.c,))
+            hi = len(self.chars_by_bdate) if born_before is None else bisect.bisect_left(self.chars_by_bdate,
+                                                                                          (born_before.c,))
+            if not candidates or hi - lo <= min(len(ids) for ids in candidates):
+                candidates.append(set(id for bdate, id in self.chars_by_bdate[lo:hi]))
+                by_date = False  # Already applied
+
+        if not candidates:
+            return [self.chars[id] for id in sorted(self.chars)]
+
+        candidates.sort(key=len)
+        ids = candidates[0].intersection(*candidates[1:])
+        chars = [self.chars[id] for id in sorted(ids)]
+        if by_date:
+            chars = [c for c in chars if (born_from is None or c.bdate >= born_from)
+                                         and (born_before is None or c.bdate < born_before)]
+        return chars
+
+    def merge_file(self, chf, log):  # Adopt a CHFile parsed by a worker process
+        if chf.filename in self.files:
+            raise CHParseError("Conflicting filenames '%s' added to single character history database" % chf.filename)
+        if self.log_verbosity > 0:
+            self.log_file.write(log)
+            self.log_file.flush()
+        chars = [c for c in chf.elems if isinstance(c, CHFileChar)]
+        for n_line, id in sorted([(c.start_line, c.id) for c in chars] + chf.lazy_ids):
+            if id in self.chars or id in self.lazy_ids:
+                raise CHParseError("Duplicate character ID found at %s: line %d!" % (chf.filename, n_line))
+        for c in chars:
+            self.index_char(c)
+        self.lazy_ids.update(id for n_line, id in chf.lazy_ids)
+        chf.ch = self
+        self.files[chf.filename] = chf
+
+    # A cache entry is found by the source's absolute path, and records the source's size, mtime, and SHA-1 as parsed.
+    # An entry whose size and mtime still match is used without reading the source at all. Where only the mtime differs
+    # (e.g., the file was touched or checked out again), the source is hashed to see whether its content still matches.
+    def cache_path(self, abs_path):
+        if isinstance(abs_path, unicode):
+            abs_path = abs_path.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(abs_path).hexdigest() + '.cache')
+
+    def load_cached(self, filename, path):  # -> CHFile, or None upon a cache miss
+        abs_path = os.path.abspath(path)
+        try:
+            with open(self.cache_path(abs_path), 'rb') as f:
+                (key, src_stat, src_sha1, summary) = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):  # Missing, truncated, or from an incompatible Python
+            key = None
+        st = os.stat(path)
+        stat = (st.st_size, st.st_mtime)
+        hit = key == (CACHE_FORMAT, abs_path) and src_stat[0] == stat[0]
+        if hit and src_stat != stat:
+            with open(path, 'rb') as f:
+                hit = hashlib.sha1(f.read()).hexdigest() == src_sha1
+        if not hit:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self.log_info("Loading '%s' from the parse cache ..." % filename)
+        chf = CHFile(self, filename, path)
+        chf.load_summary(summary, stat, src_sha1)
+        if src_stat != stat:
+            self.store_cached(chf)  # Under the new mtime, so as not to hash the source again next time
+        return chf
+
+    def store_cached(self, chf):
+        abs_path = os.path.abspath(chf.path)
+        cache_path = self.cache_path(abs_path)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            marshal.dump(((CACHE_FORMAT, abs_path), chf.src_stat, chf.src_sha1, chf.summarize()), f)
+        if os.path.exists(cache_path):  # No atomic replacing rename on Windows under Python 2
+            os.remove(cache_path)
+        os.rename(tmp_path, cache_path)
+
     def parse_file(self, filename, path):
         if filename in self.files:
             raise CHParseError("Conflicting filenames '%s' added to single character history database" % filename)
         chf = CHFile(self, filename, path)
         chf.parse()
         self.files[filename] = chf
+        if self.cache_dir is not None:
+            self.store_cached(chf)
 
-    def parse_dir(self, path):
+    def parse_dir(self, path, jobs=1):
         assert os.path.isdir(path)
         filenames = os.listdir(path)
+        tasks = []
         for filename in filenames:
             m = p_txt_file.match(filename)
             if m:
-                self.parse_file(filename, os.path.join(path, filename))
+                chf = self.load_cached(filename, os.path.join(path, filename)) if self.cache_dir is not None else None
+                if chf is not None:
+                    self.merge_file(chf, '')
+                elif jobs <= 1:
+                    self.parse_file(filename, os.path.join(path, filename))
+                else:
+                    tasks.append((filename, os.path.join(path, filename), self.log_verbosity, self.lazy_dynasties))
             else:
                 self.log_notice("Skipping possible history file '%s' due to lack of a '.txt' extension" % filename)
-
-    def rewrite(self, out_dir):
+        pool = TaskPool(jobs if tasks else 1)
+        try:
+            for chf, log in pool.run(parse_task, tasks):
+                self.merge_file(chf, log)
+                if self.cache_dir is not None:
+                    self.store_cached(chf)
+        finally:
+            pool.stop()
+
+    # Only files with dirty characters are actually rewritten; the rest are copied (or with link, hardlinked) as-is.
+    # Returns the number of files (rewritten, passed through).
+    def rewrite(self, out_dir, jobs=1, link=False):
+        dirty_files = {}
         for chf in self.files.itervalues():
-            chf.rewrite(out_dir)
+            if chf.is_dirty():
+                dirty_files[chf.filename] = chf
+            else:
+                chf.pass_through(out_dir, link)
+        n_passed = len(self.files) - len(dirty_files)
+
+        if jobs <= 1 or not hasattr(os, 'fork'):
+            for chf in dirty_files.itervalues():
+                chf.rewrite(out_dir)
+            return (len(dirty_files), n_passed)
+        global g_rewrite_files
+        g_rewrite_files = dirty_files
+        try:
+            pool = TaskPool(jobs)  # Only now, so that the forked workers inherit g_rewrite_files
+            try:
+                for filename in pool.run(rewrite_task, [(f, out_dir) for f in dirty_files]):
+                    self.log_info("Rewriting '%s' ..." % filename)
+            finally:
+                pool.stop()
+        finally:
+            del g_rewrite_files
+        return (len(dirty_files), n_passed)
 
 
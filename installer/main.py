@@ -2,12 +2,29 @@
 # -*- coding: cp1252 -*-
 # -*- python-indent-offset: 4 -*-
 
+import time
+
+g_startTime = time.time()  # For the --startup-time instrumentation
+
 import os
 import sys
+import stat
 import shutil
 import traceback
-import time
 import re
+import json
+import hashlib
+import zipfile
+import SocketServer
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # Optional backport for Python 2
+    except ImportError:
+        scandir = None
 
 
 g_version = {'major': 2, 'minor': 3, 'patch': 1,
@@ -131,7 +148,12 @@ def initLocalisation():
     }
 
 
+i18n = None
+
+
 def localise(key):
+    if i18n is None:  # Only built once it's first needed (never, for many non-interactive runs)
+        initLocalisation()
     return i18n[key][g_language]
 
 
@@ -165,6 +187,39 @@ class InstallerPackageNotFoundError(InstallerException):
         return "The installer package files (modules/ folder) were not found!"
 
 
+class InstallerUpdateError(InstallerException):
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "Cannot update the installed mod: %s. Please do a full installation." % self.reason
+
+
+class InstallerUnknownModuleError(InstallerException):
+    def __init__(self, module):
+        self.module = module
+
+    def __str__(self):
+        return "Unknown module folder '%s' given to --update (expected one of: %s)." % \
+            (self.module, ', '.join(sorted(g_moduleCompatches)))
+
+
+class InstallerMoveWrappedError(InstallerException):
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return "Refusing to move wrapped package file '%s'. Programmer error!" % self.path
+
+
+class InstallerServiceError(InstallerException):
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "Installer service: %s" % self.reason
+
+
 class NullDebugTrace:
     def __init__(self):
         pass
@@ -248,7 +303,16 @@ def isYesDefaultNo(answer):
     return answer in yesSet[g_language]
 
 
+g_firstPromptTime = None
+
+
 def promptUser(prompt, lc=True):
+    global g_firstPromptTime
+    if g_firstPromptTime is None:
+        g_firstPromptTime = time.time()
+        g_dbg.trace('time_to_first_prompt(%0.3f sec)' % (g_firstPromptTime - g_startTime))
+        if g_startupTimeMode:
+            print(u'[Time to first prompt: %0.3f sec]' % (g_firstPromptTime - g_startTime))
     sys.stdout.write(prompt + u' ')
     sys.stdout.flush()
     response = sys.stdin.readline().strip()  # TODO: broken if diff locales use non-ASCII chars in response
@@ -274,6 +338,14 @@ def enableModXOR(nameA, versionA, nameB, versionB):
     return None
 
 
+# Value of a '--name=value' command-line option, or None if the option wasn't given
+def getArgValue(name):
+    for a in sys.argv[1:]:
+        if a.startswith(name + '='):
+            return a[len(name) + 1:]
+    return None
+
+
 def quoteIfWS(s):
     return "'{}'".format(s) if ' ' in s else s
 
@@ -300,7 +372,179 @@ def mkTree(d, traceMsg=None):
     os.makedirs(d)
 
 
+# Open a file which the installer generates in the target folder for writing. Whatever was there is unlinked first, as
+# in a link-farm install it may be a link to a package file (e.g., a module's own version.txt), and writing through the
+# link would overwrite the package.
+def openGeneratedFile(path):
+    if os.path.lexists(path):
+        os.remove(path)
+    return open(path, 'w')
+
+
+# The package's modules/ folder is normally read from the filesystem, but with --package=<release.zip>, it is read
+# straight out of the release archive instead, which saves extracting every module file to disk only to copy a subset
+# of them again. The archive's member index is read once, and the package paths used everywhere else in the installer
+# (e.g., 'modules/SWMH/common/foo.txt') are mapped onto its members, whatever folder the archive has modules/ inside.
+g_archive = None
+g_archiveIndex = {}  # Native package path => ZipInfo of each file member
+g_archiveTree = {}   # Native package path => ([subdirectory names], [file names]) of each directory
+g_archiveWorkers = 4
+
+
+def openArchive(path):
+    global g_archive
+    g_dbg.push('open_archive("{}")'.format(path))
+    g_archive = zipfile.ZipFile(path, 'r')
+    infos = g_archive.infolist()
+
+    # Find the shallowest modules/ folder in the archive, and treat everything above it as the archive's prefix
+    prefix = None
+    for info in infos:
+        parts = info.filename.split('/')
+        if 'modules' in parts[:-1]:
+            p = '/'.join(parts[:parts.index('modules')])
+            if prefix is None or len(p) < len(prefix):
+                prefix = p
+    if prefix is None:
+        raise InstallerPackageNotFoundError()
+    if prefix:
+        prefix += '/'
+
+    for info in infos:
+        if not info.filename.startswith(prefix + 'modules/'):
+            continue
+        path = os.path.normpath(info.filename[len(prefix):])
+        if info.filename.endswith('/'):
+            g_archiveTree.setdefault(path, ([], []))
+        else:
+            g_archiveIndex[path] = info
+            d, f = os.path.split(path)
+            g_archiveTree.setdefault(d, ([], []))[1].append(f)
+            path = d
+        # Link each directory into all of its ancestors
+        while path != 'modules':
+            d, name = os.path.split(path)
+            entry = g_archiveTree.setdefault(d, ([], []))
+            if name in entry[0]:
+                break
+            entry[0].append(name)
+            path = d
+
+    g_dbg.pop('num_archive_files({})'.format(len(g_archiveIndex)))
+
+
+def packagePathExists(path):
+    if g_archive:
+        path = os.path.normpath(path)
+        return path in g_archiveTree or path in g_archiveIndex
+    return os.path.exists(path)
+
+
+def openPackageFile(path):
+    if g_archive:
+        return g_archive.open(g_archiveIndex[os.path.normpath(path)])
+    return open(path, 'rb')
+
+
+# Module folders are independent of each other until their overlay is merged, so all of the module folders which an
+# install pushes are first scanned in parallel (into the same kind of directory tree as the archive's), and only then is
+# the overlay merged in the order in which it was requested. The scan uses os.scandir() (or the scandir backport for
+# Python 2, if it's available), which classifies directory entries without a stat() call per entry on most platforms.
+# Outside of Windows, it also records each file's inode number, which readdir() provides for free, for ioOrderKey.
+g_scanTree = {}  # Native package path => ([subdirectory names], [file names]) of each scanned directory
+g_scanInodes = {}  # Native package path => inode number of each scanned file
+g_scanWorkers = 8
+
+
+def scanFolder(top):
+    tree = {}
+    inodes = {}
+    stack = [top]
+    while stack:
+        d = stack.pop()
+        dirs = []
+        files = []
+        try:
+            if scandir:
+                for e in scandir(d):
+                    if e.is_dir():
+                        dirs.append(e.name)
+                    else:
+                        files.append(e.name)
+                        if os.name != 'nt':  # Where inode() would cost a stat() call
+                            inodes[e.path] = e.inode()
+            else:
+                for name in os.listdir(d):
+                    (dirs if os.path.isdir(os.path.join(d, name)) else files).append(name)
+        except OSError:
+            continue
+        tree[d] = (dirs, files)
+        stack.extend(os.path.join(d, x) for x in dirs)
+    return tree, inodes
+
+
+def scanFolders(folders):
+    g_dbg.push('scan_folders(num_folders({}), workers({}), scandir({}))'.format(len(folders), g_scanWorkers,
+                                                                             scandir is not None))
+    pool = ThreadPool(g_scanWorkers)
+    try:
+        for tree, inodes in pool.imap_unordered(scanFolder, folders):
+            g_scanTree.update(tree)
+            g_scanInodes.update(inodes)
+    finally:
+        pool.terminate()
+    g_dbg.pop('num_dirs_scanned({})'.format(len(g_scanTree)))
+
+
+def walkTree(tree, top):
+    dirs, files = tree.get(top, ([], []))
+    dirs = sorted(dirs)
+    yield top, dirs, sorted(files)
+    for d in dirs:
+        for x in walkTree(tree, os.path.join(top, d)):
+            yield x
+
+
+# Like os.walk() (top-down, and honoring in-place pruning of the yielded subdirectory list), but over the package
+def walkPackage(top):
+    if g_archive:
+        return walkTree(g_archiveTree, top)
+    if top in g_scanTree:
+        return walkTree(g_scanTree, top)
+    return os.walk(top)
+
+
+# The overlay operations (pushFolder, popFile, and popTree) are only queued as the installer works through the module
+# selection. resolveOverlay() then scans every pushed module folder at once and applies the queued operations to
+# g_targetSrc in their original order, so precedence among the modules is exactly as requested.
+g_overlayOps = []
+
+
 def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPaths=None):
+    g_overlayOps.append((applyPushFolder, (folder, targetFolder, ignoreFiles, prunePaths, wrapPaths)))
+
+
+def popFile(f, targetFolder):
+    g_overlayOps.append((applyPopFile, (f, targetFolder)))
+
+
+def popTree(d, targetFolder):
+    g_overlayOps.append((applyPopTree, (d, targetFolder)))
+
+
+def resolveOverlay():
+    g_dbg.push('resolve_overlay')
+    if not g_archive:  # Folders already scanned by an earlier request to the installer service are reused
+        folders = [os.path.join('modules', os.path.normpath(args[0]))
+                   for op, args in g_overlayOps if op is applyPushFolder]
+        scanFolders([x for x in folders if x not in g_scanTree])
+    for op, args in g_overlayOps:
+        op(*args)
+    del g_overlayOps[:]
+    g_dbg.pop()
+
+
+def applyPushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPaths=None):
     if ignoreFiles is None:
         ignoreFiles = set()
     if prunePaths is None:
@@ -315,7 +559,7 @@ def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPath
     folder = os.path.normpath(folder)
     srcFolder = os.path.join('modules', folder)
 
-    if not os.path.exists(srcFolder):
+    if not packagePathExists(srcFolder):
         g_dbg.trace("MODULE_NOT_FOUND('{}')".format(folder))
         return
 
@@ -331,7 +575,7 @@ def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPath
     for x in prunePaths:
         g_dbg.trace('path_filter("{}")'.format(x))
 
-    for root, dirs, files in os.walk(srcFolder):
+    for root, dirs, files in walkPackage(srcFolder):
         newRoot = root.replace(srcFolder, targetFolder)
         g_dbg.push('push_dir("{}")'.format(root))
 
@@ -385,7 +629,7 @@ def pushFolder(folder, targetFolder, ignoreFiles=None, prunePaths=None, wrapPath
     g_dbg.pop()
 
 
-def popFile(f, targetFolder):
+def applyPopFile(f, targetFolder):
     f = os.path.normpath(f)
     p = os.path.join(targetFolder, f)
     if p in g_targetSrc:
@@ -393,7 +637,7 @@ def popFile(f, targetFolder):
         del g_targetSrc[p]
 
 
-def popTree(d, targetFolder):
+def applyPopTree(d, targetFolder):
     d = os.path.normpath(d)
     t = os.path.join(targetFolder, d)
     g_dbg.push("pop_path_prefix('{}')".format(t))
@@ -415,52 +659,525 @@ def stripPathHead(path):
     return path[newStart:]
 
 
+# The package wrapping codec, which shrinkwrap.py (the package build tool) also imports from here. Wrapping and
+# unwrapping are the same XOR with the key, either of the whole file or (WRAP_QUICK) of only its header.
 g_k  = bytearray(br'"The enemy of a good plan is the dream of a perfect plan" - Carl von Clausewitz')
+g_wrapHeaderLen = 1 << 12
 
 
-def unwrapBuffer(buf, length):
+def unwrapBuffer(buf, length, offset=0):  # offset is that of buf within the file
     kN = len(g_k)
     for i in xrange(length):
-        buf[i] ^= g_k[i % kN]
+        buf[i] ^= g_k[(offset + i) % kN]
+
+
+def unwrapData(buf, quickMode=False):
+    length = len(buf)
+    if quickMode:
+        length = min(g_wrapHeaderLen, length)
+    unwrapBuffer(buf, length)
 
 
+# The functions which write a destination file return its SHA-1, computed from the data as it's written, so that
+# compileTarget's checkpoint never needs to read the file back.
 def unwrapToFile(src, dst, quickMode=False):
-    length = os.path.getsize(src)
-    buf = bytearray(length)
+    buf = bytearray(os.path.getsize(src))
     with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
         fsrc.readinto(buf)
-        if quickMode:
-            length = min(1 << 12, length)
-        unwrapBuffer(buf, length)
+        unwrapData(buf, quickMode)
+        fdst.write(buf)
+    return hashlib.sha1(buf).hexdigest()
+
+
+def copyFileObj(fsrc, fdst):
+    h = hashlib.sha1()
+    while True:
+        chunk = fsrc.read(1 << 20)
+        if not chunk:
+            break
+        h.update(chunk)
+        fdst.write(chunk)
+    return h.hexdigest()
+
+
+def copyToFile(src, dst):  # Like shutil.copy()
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        sha1 = copyFileObj(fsrc, fdst)
+    shutil.copymode(src, dst)
+    return sha1
+
+
+def extractToFile(src, dst, wrap=WRAP_NONE):
+    with openPackageFile(src) as fsrc, open(dst, 'wb') as fdst:
+        if wrap == WRAP_NONE:
+            return copyFileObj(fsrc, fdst)
+        buf = bytearray(fsrc.read())
+        unwrapData(buf, quickMode=(wrap == WRAP_QUICK))
         fdst.write(buf)
+    return hashlib.sha1(buf).hexdigest()
+
+
+def hashFileObj(h, f):
+    while True:
+        chunk = f.read(1 << 16)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h
+
+
+def hashFile(h, path):
+    with open(path, 'rb') as f:
+        return hashFileObj(h, f)
+
+
+# Optional (--unwrap-cache) local cache of fully-unwrapped package files, which are keyed by the SHA-1 of their wrapped
+# source content and of the wrapping key. CPRplus's gfx only changes between CPRplus releases, but fully unwrapping it
+# in pure Python is by far the slowest part of any install which includes it. Header-only (WRAP_QUICK) unwrapping is
+# already as cheap as a plain copy, so it bypasses the cache. The cache is capped in size, and entries are evicted in
+# least-recently-used order, where recency is tracked via each entry's mtime. A source file is only read once, whether
+# it's a hit or a miss: the key is hashed from the same buffer which is then unwrapped upon a miss.
+g_unwrapCacheFolder = 'HIP_unwrap_cache'
+g_unwrapCacheMaxBytes = 1 << 30
+
+
+class UnwrapCache:
+    def __init__(self, folder, maxBytes):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(folder):
+            mkTree(folder)
+
+    def unwrapToFile(self, src, dst):
+        buf = bytearray(os.path.getsize(src))
+        with open(src, 'rb') as fsrc:
+            fsrc.readinto(buf)
+        h = hashlib.sha1(g_k)
+        h.update(buf)
+        entry = os.path.join(self.folder, h.hexdigest())
+        if os.path.exists(entry):
+            self.hits += 1
+            sha1 = copyToFile(entry, dst)
+            os.utime(entry, None)  # Mark as most recently used
+            return sha1
+        self.misses += 1
+        unwrapData(buf)
+        with open(dst, 'wb') as fdst:
+            fdst.write(buf)
+        tmpEntry = entry + '.tmp'  # Never leave a partially-written entry behind under its real name
+        with open(tmpEntry, 'wb') as fentry:
+            fentry.write(buf)
+        os.rename(tmpEntry, entry)
+        return hashlib.sha1(buf).hexdigest()
+
+    def evict(self):
+        entries = []
+        totalBytes = 0
+        for e in os.listdir(self.folder):
+            path = os.path.join(self.folder, e)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            totalBytes += st.st_size
+        nEvicted = 0
+        for _, size, path in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(path)
+            totalBytes -= size
+            nEvicted += 1
+        g_dbg.trace('unwrap_cache(hits({}), misses({}), evicted({}), bytes({}))'.format(self.hits, self.misses,
+                                                                                      nEvicted, totalBytes))
+
+
+# Sort key for the read phase of compileTarget: group source files by module folder, then by source directory, then
+# by inode number, which on most filesystems approximates on-disk allocation order far better than the destination
+# path does. The inode numbers are those recorded by the folder scan, so no file is stat()ed just to order it. Where
+# there are none (on Windows, or without scandir), the source path breaks the tie so that the order is still stable.
+def ioOrderKey(dstPath):
+    src = g_targetSrc[dstPath]
+    if g_archive:  # Archive members are simply read in the order in which they're stored
+        return (g_archiveIndex[src.srcPath].header_offset,)
+    return (src.folder, os.path.dirname(src.srcPath), g_scanInodes.get(src.srcPath, 0), src.srcPath)
+
+
+def scheduleReads(dstPaths):
+    g_dbg.push('io_schedule(num_files({}))'.format(len(dstPaths)))
+    dstPaths = sorted(dstPaths, key=ioOrderKey)
+    folder = None
+    for p in dstPaths:
+        if g_targetSrc[p].folder != folder:
+            folder = g_targetSrc[p].folder
+            g_dbg.trace('read_module("{}")'.format(folder))
+    g_dbg.pop()
+    return dstPaths
+
+
+# compileTarget records a checkpoint of every destination file it has completed (with its size and SHA-1) in the
+# target folder, flushed at least every few seconds, so that an interrupted install can be continued with --resume.
+# The checkpoint starts with an identifier of the install plan, which covers the package version, the install mode,
+# and every destination file's source. Resuming is only possible when the plan is identical; otherwise, the target
+# folder is rebuilt from scratch. The checkpoint is removed once compilation is complete.
+g_checkpointFilename = 'HIP_checkpoint.txt'
+g_checkpointInterval = 5  # Seconds
+
+
+def getPlanID(dstPaths):
+    h = hashlib.sha1('{}\n{}\n'.format(g_versions['pkg'].encode('utf-8'), g_linkFarm))
+    for dstPath in dstPaths:
+        src = g_targetSrc[dstPath]
+        h.update('{}\t{}\t{}\t{}\n'.format(dstPath, src.folder, src.srcPath, src.wrap))
+    return h.hexdigest()
+
+
+# Returns a dict of destination path => (size, SHA-1) for the files completed according to the checkpoint file, or
+# None if there's no checkpoint file for the given plan.
+def loadCheckpoint(path, planID):
+    if not os.path.exists(path):
+        g_dbg.trace('checkpoint(NOT_FOUND)')
+        return None
+    done = {}
+    with open(path, 'r') as f:
+        if f.readline().rstrip('\r\n') != 'plan ' + planID:
+            g_dbg.trace('checkpoint(INCOMPATIBLE_PLAN)')
+            return None
+        for line in f:
+            entry = line.rstrip('\r\n').split(' ', 2)
+            if len(entry) == 3:  # Else, it's a truncated final entry
+                done[entry[2]] = (int(entry[0]), entry[1])
+    g_dbg.trace('checkpoint(num_files({}))'.format(len(done)))
+    return done
+
+
+# Moved and linked files are recorded without a SHA-1 ('-'), as nothing was read to compute one; those are created
+# atomically by a rename or link, so they're complete if they exist at all.
+def isCompiledFileIntact(dstPath, size, sha1):
+    return os.path.isfile(dstPath) and os.path.getsize(dstPath) == size and \
+        (sha1 == '-' or hashFile(hashlib.sha1(), dstPath).hexdigest() == sha1)
+
+
+# The file-to-module map is always written in sorted destination order, independent of the I/O order of
+# compileTarget, so that it stays deterministic and diffable between installs.
+def writeFile2ModMap(mapFilename, dstPaths):
+    with openGeneratedFile(mapFilename) as mapFile:
+        for dstPath in dstPaths:
+            mapFile.write('%s <= [%s]\n' % (stripPathHead(dstPath), g_targetSrc[dstPath].folder))
+
+
+def readFile2ModMap(mapFilename):
+    p_entry = re.compile(r'^(.*) <= \[(.*)\]$')
+    installed = {}
+    with open(mapFilename, 'r') as mapFile:
+        for line in mapFile:
+            m = p_entry.match(line.rstrip('\r\n'))
+            if m:
+                installed[m.group(1)] = m.group(2)
+    return installed
+
+
+# Produce a single destination file from its package source, replacing any preexisting file if so requested. Returns
+# the file's path, size, and SHA-1 (or '-' if it was moved or linked) for the checkpoint.
+def compileFile(dstPath, journal=None, replace=False):
+    src = g_targetSrc[dstPath]
+
+    if replace and os.path.lexists(dstPath):
+        os.remove(dstPath)
+
+    if g_archive:
+        sha1 = extractToFile(src.srcPath, dstPath, src.wrap)
+    elif src.wrap == WRAP_QUICK:
+        sha1 = unwrapToFile(src.srcPath, dstPath, quickMode=True)
+    elif src.wrap == WRAP_TOTAL:
+        if g_unwrapCache:
+            sha1 = g_unwrapCache.unwrapToFile(src.srcPath, dstPath)
+        else:
+            sha1 = unwrapToFile(src.srcPath, dstPath)
+    elif g_move:
+        sha1 = moveFile(src, dstPath, journal)
+    elif g_linkFarm:
+        sha1 = linkFile(src, dstPath)
+    else:
+        sha1 = copyToFile(src.srcPath, dstPath)
+
+    g_compiledHashes[dstPath] = sha1
+    return dstPath, os.path.getsize(dstPath), sha1 or '-'
 
 
 def compileTarget(mapFilename):
     print(localise('COMPILING'))
     sys.stdout.flush()
 
-    x = len(g_targetSrc) // 20
+    dstPaths = sorted(g_targetSrc)
+
+    targetFolder = os.path.dirname(mapFilename)
+    checkpointFilename = os.path.join(targetFolder, g_checkpointFilename)
+    planID = getPlanID(dstPaths)
+    g_dbg.trace('plan_id({})'.format(planID))
+    done = None
+
+    if g_resumeMode:
+        done = loadCheckpoint(checkpointFilename, planID)
+        if done is None:
+            print(u'> Nothing compatible to resume, so compiling from scratch ...')
+            rmTree(targetFolder, 'rm_unresumable_mod("{}")'.format(targetFolder))
+            mkTree(targetFolder)
+
+    writeFile2ModMap(mapFilename, dstPaths)
+
+    # Create the entire destination directory skeleton up front (sorted order guarantees that parents come before
+    # their children). After that, no file write depends upon any other, so the files can be processed in the order
+    # which is cheapest for the source media rather than in destination order.
+    for dstPath in dstPaths:
+        if g_targetSrc[dstPath].isDir and not os.path.isdir(dstPath):
+            mkTree(dstPath)
+
+    filePaths = scheduleReads([p for p in dstPaths if not g_targetSrc[p].isDir])
+
+    checkpoint = openGeneratedFile(checkpointFilename)
+    checkpoint.write('plan {}\n'.format(planID))
+
+    if done:
+        print(u'> Verifying files completed by the previous run ...')
+        sys.stdout.flush()
+        g_dbg.push('verify_checkpoint')
+        todo = []
+        for dstPath in filePaths:
+            if dstPath in done and isCompiledFileIntact(dstPath, *done[dstPath]):
+                checkpoint.write('{} {} {}\n'.format(done[dstPath][0], done[dstPath][1], dstPath))
+                g_compiledHashes[dstPath] = done[dstPath][1] if done[dstPath][1] != '-' else None
+            else:
+                g_dbg.trace('redo("{}")'.format(dstPath))
+                todo.append(dstPath)
+        g_dbg.pop('num_files_resumed({})'.format(len(filePaths) - len(todo)))
+        print(u'> Resuming with {} of {} files left to compile.'.format(len(todo), len(filePaths)))
+        filePaths = todo
+
+    checkpoint.flush()
+    lastCheckpointTime = time.time()
+
+    x = len(filePaths) // 20
+
+    journal = None
+
+    if g_move:
+        g_dbg.trace('open_move_journal("{}")'.format(g_moveJournalFilename))
+        journal = open(g_moveJournalFilename, 'w')
+
+    # When resuming, any file not verified above may be a partially-written leftover of the interrupted run
+    replace = done is not None
+
+    def compileFileTask(dstPath):
+        return compileFile(dstPath, journal, replace)
+
+    # Archive members are extracted by several worker threads at once, each reading the archive through its own file
+    # handle, so that reading one member overlaps with decompressing and writing others (zlib releases the GIL while
+    # inflating). The pure-Python unwrap of wrapped members holds the GIL, though, so it doesn't run in parallel.
+    if g_archive:
+        g_dbg.trace('archive_workers({})'.format(g_archiveWorkers))
+        pool = ThreadPool(g_archiveWorkers)
+        results = pool.imap_unordered(compileFileTask, filePaths)
+    else:
+        pool = None
+        results = (compileFileTask(p) for p in filePaths)
 
-    with open(mapFilename, "w") as mapFile:
-        for n, dstPath in enumerate(sorted(g_targetSrc)):
+    try:
+        for n, (dstPath, size, sha1) in enumerate(results):
+            checkpoint.write('{} {} {}\n'.format(size, sha1, dstPath))
+            if time.time() - lastCheckpointTime >= g_checkpointInterval:
+                checkpoint.flush()
+                lastCheckpointTime = time.time()
 
             if n and x and n % x == 0:
                 print(u"{}%".format((n // x * 5)))
                 sys.stdout.flush()
+    finally:
+        checkpoint.close()
+        if pool:
+            pool.terminate()
 
-            src = g_targetSrc[dstPath]
-            mapFile.write('%s <= [%s]\n' % (stripPathHead(dstPath), src.folder))
+    rmFile(checkpointFilename)
 
-            if src.isDir:
+    if g_move:
+        journal.close()
+
+    if g_unwrapCache:
+        g_unwrapCache.evict()
+
+
+# Hot update (--update=<module folder>) of an existing installation after one module's files changed, e.g. when a new
+# SWMH build was dropped into modules/SWMH. The overlay is resolved as usual, but only destination entries which could
+# be affected are touched: entries which are new or gone, entries whose winning module changed (newly shadowed or
+# uncovered files), and entries won by the changed module or by any of its compatches. Everything else is left as it
+# was installed. This requires that the installed mod's version.txt shows the same package release and the same module
+# selection, as only module versions may differ.
+#
+# Module folder => the compatch folders which mergeModules() pushes on its behalf (keep in sync with mergeModules)
+g_moduleCompatches = {
+    'ArumbaKS': ['ArkoInterface+AKS', 'SWMH+AKS', 'SWMH+ArkoInterface+AKS'],
+    'ARKOpack_Interface': ['ArkoInterface+AKS', 'SWMH+ArkoInterface', 'SWMH+ArkoInterface+AKS', 'EMF+ArkoInterface'],
+    'VIET_Assets': ['SED2+VIET'],
+    'HIP_Common': [],
+    'SWMH': ['SWMH+ArkoInterface', 'SWMH+ArkoInterface+AKS', 'SWMH+AKS', 'NBRT+SWMH', 'EMF+SWMH',
+             'CPRplus-compatch/SWMH'],
+    'MiniSWMH': ['SED2+MiniSWMH', 'EMF+MiniSWMH'],
+    'SED2': ['SED2+EMF', 'SED2+VIET', 'SED2+MiniSWMH'],
+    'ARKOpack_Armoiries': ['NBRT+ARKO'],
+    'NBRT+': ['NBRT+SWMH', 'NBRT+ARKO'],
+    'VIET_Traits': ['SED2+VIET'],
+    'VIET_Events': ['SED2+VIET'],
+    'EMF': ['EMF+SWMH', 'EMF+MiniSWMH', 'EMF+Vanilla', 'EMF+ArkoInterface', 'SED2+EMF', 'CPRplus-compatch/EMF'],
+    'CPRplus': ['CPRplus-compatch/CustomFaces', 'CPRplus-compatch/SWMH', 'CPRplus-compatch/EMF'],
+}
+
+
+def checkUpdateModule(module):
+    if module not in g_moduleCompatches:
+        raise InstallerUnknownModuleError(module)
+
+
+def isModuleRelated(folder, module):  # folder is normalized, as by applyPushFolder()
+    return folder == module or folder in [os.path.normpath(x) for x in g_moduleCompatches[module]]
+
+
+def getInstalledSelection(versionFilename):
+    with open(versionFilename, 'r') as f:
+        lines = [line.rstrip('\r\n') for line in f]
+    # Strip each module's version, as in "SWMH (3.141)"
+    return [lines[0]] + [line.rsplit(' (', 1)[0] for line in lines[1:]]
+
+
+def checkUpdatable(targetFolder, moduleOutput):
+    mapFilename = os.path.join(targetFolder, "file2mod_map.txt")
+    versionFilename = os.path.join(targetFolder, "version.txt")
+    if not (os.path.exists(mapFilename) and os.path.exists(versionFilename)):
+        raise InstallerUpdateError('no installation to update')
+    selection = [line.rstrip('\n') for line in moduleOutput]
+    selection = [selection[0]] + [line.rsplit(' (', 1)[0] for line in selection[1:]]
+    if getInstalledSelection(versionFilename) != selection:
+        raise InstallerUpdateError('the package release or module selection differs from the installation')
+
+
+def updateTarget(mapFilename, module):
+    print(u'> Updating ...')
+    sys.stdout.flush()
+    g_dbg.push('update_module("{}")'.format(module))
+
+    targetFolder = os.path.dirname(mapFilename)
+    installed = readFile2ModMap(mapFilename)
+    plan = {stripPathHead(p): p for p in g_targetSrc}
+
+    # Remove what is gone first, in reverse order so that children go before their parents
+    nRemoved = 0
+    for rel in sorted(installed, reverse=True):
+        if rel in plan:
+            continue
+        path = os.path.join(targetFolder, rel)
+        if os.path.isdir(path) and not os.path.islink(path):
+            rmTree(path)
+        elif os.path.lexists(path):
+            rmFile(path)
+        nRemoved += 1
+
+    nUpdated = 0
+    for rel in sorted(plan):
+        dstPath = plan[rel]
+        src = g_targetSrc[dstPath]
+        if installed.get(rel) == src.folder and not isModuleRelated(src.folder, module):
+            continue
+        if src.isDir:
+            if not os.path.isdir(dstPath):
                 mkTree(dstPath)
-            elif g_move and src.wrap == WRAP_NONE:
-                shutil.move(src.srcPath, dstPath)
-            elif src.wrap == WRAP_NONE:
-                shutil.copy(src.srcPath, dstPath)
-            elif src.wrap == WRAP_QUICK:
-                unwrapToFile(src.srcPath, dstPath, quickMode=True)
-            elif src.wrap == WRAP_TOTAL:
-                unwrapToFile(src.srcPath, dstPath)
+            continue
+        g_dbg.trace('update("{}" <= [{}])'.format(rel, src.folder))
+        compileFile(dstPath, replace=True)
+        nUpdated += 1
+
+    writeFile2ModMap(mapFilename, sorted(g_targetSrc))
+    g_dbg.pop('num_files_updated({}), num_removed({})'.format(nUpdated, nRemoved))
+    print(u'> Updated {} files and removed {} entries.'.format(nUpdated, nRemoved))
+
+
+# Journal of the renames done by a move-mode install. It lives beside modules/ rather than in the target folder,
+# because an interrupted install's target folder is removed by the next run, and it is only deleted once the install
+# has completed. Each line is written (and flushed) *before* its rename happens, so rollbackMoveJournal() can always
+# restore the package by renaming back whatever was actually moved.
+g_moveJournalFilename = 'HIP_move_journal.txt'
+
+
+def moveFile(src, dstPath, journal):
+    # Wrapped sources must always be decoded into the target and never moved there as-is
+    if src.wrap != WRAP_NONE:
+        raise InstallerMoveWrappedError(src.srcPath)
+
+    # A move across filesystems would just be a copy and a delete, so copy and leave the package file intact
+    if os.stat(src.srcPath).st_dev != os.stat(os.path.dirname(dstPath)).st_dev:
+        return copyToFile(src.srcPath, dstPath)
+
+    journal.write('{}\t{}\n'.format(src.srcPath, dstPath))
+    journal.flush()
+    os.rename(src.srcPath, dstPath)
+    return None
+
+
+# Link-farm installs (--link-farm) are meant for module developers who reinstall constantly: rather than copying each
+# unwrapped package file, the target gets a link to it, so edits in modules/ show up in the installed mod right away.
+# Wrapped files are still unwrapped into the target as usual. Symlinks are preferred where the game follows them (Mac
+# and Linux); hardlinks are used elsewhere (cygwin creates real NTFS hardlinks), but Python 2 on Windows supports
+# neither. Note that a hardlink no longer reflects a file which an editor saves by replacing it.
+def getLinkFarmMode():
+    if g_platform in ('mac', 'lin') and hasattr(os, 'symlink'):
+        return 'symlink'
+    if hasattr(os, 'link'):
+        return 'hardlink'
+    return None
+
+
+def linkFile(src, dstPath):
+    global g_linkFarm
+    try:
+        if g_linkFarm == 'symlink':
+            os.symlink(os.path.abspath(src.srcPath), dstPath)
+            return None
+        if os.stat(src.srcPath).st_dev == os.stat(os.path.dirname(dstPath)).st_dev:
+            os.link(src.srcPath, dstPath)
+            return None
+    except OSError as e:
+        # The target filesystem doesn't do links (e.g., FAT32 / exFAT), so the game couldn't follow them anyway
+        print(u'WARNING: Cannot create links in the target folder ({}). Copying files instead.'.format(e.strerror))
+        g_dbg.trace('link_farm_failed("{}" => "{}")'.format(src.srcPath, e.strerror))
+        g_linkFarm = None
+    return copyToFile(src.srcPath, dstPath)
+
+
+# If a previous move-mode install was interrupted, part of the package now lives in its (partial) target folder, so
+# we move every journaled file back into modules/ before doing anything else. Since moves are metadata-only, simply
+# redoing the install afterward is as cheap as resuming it would be.
+def rollbackMoveJournal():
+    if not os.path.exists(g_moveJournalFilename):
+        return
+
+    print(u'> Restoring package files from an interrupted installation ...')
+    sys.stdout.flush()
+    g_dbg.push('rollback_move_journal("{}")'.format(g_moveJournalFilename))
+
+    with open(g_moveJournalFilename, 'r') as f:
+        entries = [line.rstrip('\r\n').split('\t') for line in f]
+
+    nRestored = 0
+
+    for entry in reversed(entries):
+        if len(entry) != 2:  # Truncated final entry (its rename never happened)
+            continue
+        srcPath, dstPath = entry
+        if os.path.exists(dstPath) and not os.path.exists(srcPath):
+            g_dbg.trace('restore("{}" => "{}")'.format(dstPath, srcPath))
+            os.rename(dstPath, srcPath)
+            nRestored += 1
+
+    rmFile(g_moveJournalFilename)
+    g_dbg.pop('num_files_restored({})'.format(nRestored))
+    print(u'> Restored {} files.\n'.format(nRestored))
 
 
 def detectPlatform():
@@ -478,18 +1195,61 @@ def detectPlatform():
 
 def cleanUserDir(userDir):
     g_dbg.push('clean_userdir("{}")'.format(userDir))
-    for d in [os.path.join(userDir, e) for e in ['gfx', 'map']]:
+    for d in [os.path.join(userDir, e) for e in g_cachedFolders]:
         rmTree(d)
     g_dbg.pop()
 
 
-def resetCaches():
+# The game's gfx/map caches in a user_dir are built only from the mod's gfx/ and map/ content, so a digest of the
+# installed gfx/ and map/ files is recorded in the target folder, and the caches are only cleared when it changes.
+# Otherwise, a reinstall which only changed events or localisation would still cost minutes of map cache rebuilding
+# upon the next launch of the game. The digest file also lists the SHA-1 of every gfx/map file, so that a hot update can
+# reuse the hashes of the files which it didn't touch. It's written only after the caches have been dealt with.
+g_cacheDigestFilename = 'cache_digest.txt'
+g_cachedFolders = ['gfx', 'map']
+g_compiledHashes = {}  # Destination path => SHA-1 of each file compiled (or verified intact on resume) by this run, or
+                      # None for moved & linked files, which must be hashed from scratch
+
+
+# Returns the digest and the file hashes recorded in an installed mod, or (None, {}) if there's no record
+def readCacheDigest(targetFolder):
+    path = os.path.join(targetFolder, g_cacheDigestFilename)
+    hashes = {}
+    if not os.path.exists(path):
+        return None, hashes
+    with open(path, 'r') as f:
+        digest = f.readline().rstrip('\r\n')
+        for line in f:
+            entry = line.rstrip('\r\n').split(' ', 1)
+            if len(entry) == 2:
+                hashes[entry[1]] = entry[0]
+    return digest, hashes
+
+
+def getCacheDigest(oldHashes):
+    h = hashlib.sha1()
+    hashes = {}
+    for dstPath in sorted(g_targetSrc):
+        rel = stripPathHead(dstPath).replace('\\', '/')
+        if g_targetSrc[dstPath].isDir or rel.split('/', 1)[0] not in g_cachedFolders:
+            continue
+        sha1 = g_compiledHashes.get(dstPath, oldHashes.get(rel)) or hashFile(hashlib.sha1(), dstPath).hexdigest()
+        hashes[rel] = sha1
+        h.update('{} {}\n'.format(sha1, rel))
+    return h.hexdigest(), hashes
+
+
+def writeCacheDigest(targetFolder, digest, hashes):
+    with openGeneratedFile(os.path.join(targetFolder, g_cacheDigestFilename)) as f:
+        f.write(digest + '\n')
+        for rel in sorted(hashes):
+            f.write('{} {}\n'.format(hashes[rel], rel))
+
+
+def getHIPUserDirs():
     if g_platform == 'mac':
-        print(u'Clearing preexisting CKII gfx/map cache')
-        cleanUserDir('..')  # TODO: Find out if the user_dir changes with the new 2.1.5 launcher
+        return ['..']  # TODO: Find out if the user_dir changes with the new 2.1.5 launcher
     elif g_platform == 'win' or g_platform == 'cyg':
-        print(u'Clearing preexisting HIP-related CKII gfx/map caches ...')
-
         # Match *all* userdirs in CKII user directory which include 'HIP' in their
         # directory name, as this also covers all cases with external mods used with
         # HIP, and then clear their caches. It works, because, without editing the
@@ -498,11 +1258,33 @@ def resetCaches():
         # user_dir name.
 
         dirEntries = [os.path.join('..', e) for e in os.listdir('..')]
-        for userDir in dirEntries:
-            if os.path.isdir(userDir) and 'HIP' in userDir:
-                cleanUserDir(userDir)
+        return [d for d in dirEntries if os.path.isdir(d) and 'HIP' in d]
     else:
-        pass  # TODO: Find out if the user_dir changes with the new 2.1.5 launcher
+        return []  # TODO: Find out if the user_dir changes with the new 2.1.5 launcher
+
+
+def resetCaches(targetFolder, oldDigest, oldHashes):
+    digest, hashes = getCacheDigest(oldHashes)
+    g_dbg.push('reset_caches(old_digest({}), new_digest({}))'.format(oldDigest, digest))
+    userDirs = getHIPUserDirs()
+
+    if digest == oldDigest:
+        if userDirs:
+            print(u'Keeping preexisting CKII gfx/map caches, as the installed gfx/ and map/ did not change.')
+        for userDir in userDirs:
+            g_dbg.trace('keep_userdir("{}", reason(GFX_MAP_UNCHANGED))'.format(userDir))
+    else:
+        if g_platform == 'mac':
+            print(u'Clearing preexisting CKII gfx/map cache')
+        elif userDirs:
+            print(u'Clearing preexisting HIP-related CKII gfx/map caches ...')
+        reason = 'NO_PREVIOUS_DIGEST' if oldDigest is None else 'GFX_MAP_CHANGED'
+        for userDir in userDirs:
+            g_dbg.trace('reset_userdir("{}", reason({}))'.format(userDir, reason))
+            cleanUserDir(userDir)
+
+    writeCacheDigest(targetFolder, digest, hashes)
+    g_dbg.pop()
 
 
 # Changes the current working directory to the same as that of the
@@ -587,14 +1369,18 @@ def getPkgVersions(modDirs):
     g_dbg.push("read_versions")
     for mod in modDirs.keys():
         f = os.path.join("modules", modDirs[mod], "version.txt")
-        if os.path.exists(f):
-            g_versions[mod] = unicode(open(f).readline().strip())
+        if packagePathExists(f):
+            with openPackageFile(f) as vf:
+                g_versions[mod] = unicode(vf.readline().strip())
         else:
             g_versions[mod] = u'no version'
         g_dbg.trace("version('%s' => '%s')" % (mod, g_versions[mod]))
     g_dbg.pop()
 
 
+g_defaultFolder = 'Historical Immersion Project'
+
+
 def getInstallOptions():
     # Determine user g_language for installation
     global g_language
@@ -619,15 +1405,24 @@ def getInstallOptions():
 
     global g_move
     #g_move = False if (g_steamMode or g_zijiMode) else isYes(promptUser(localise('MOVE_VS_COPY')))
-    g_move = False
+    # Nothing to move out of a read-only archive, and an update must leave the package intact
+    g_move = g_moveMode and not g_archive and not g_linkFarmMode and not g_updateMode
 
-    if g_move:
+    if g_move and not (g_steamMode or g_zijiMode):
         g_move = isYes(promptUser(localise('MOVE_CONFIRM')))
     g_dbg.trace('move_instead_of_copy({})'.format(g_move))
 
+    global g_linkFarm
+    g_linkFarm = getLinkFarmMode() if (g_linkFarmMode and not g_archive) else None
+
+    if g_linkFarmMode and not g_linkFarm:
+        print(u'WARNING: Link-farm installation is not supported here. Copying files instead.')
+    elif g_linkFarm == 'hardlink':
+        print(u'NOTE: Installing hardlinks to the package files. Edits saved by replacing a module file\n'
+              u'(as many editors do) will not show up in the installed mod until you reinstall.')
+    g_dbg.trace('link_farm({})'.format(g_linkFarm))
+
     # Determine installation target folder...
-    global g_defaultFolder
-    g_defaultFolder = 'Historical Immersion Project'
     targetFolder = ''
 
     # FIXME: `or not g_betaMode` is only for the EMF 4 Beta Installer
@@ -796,13 +1591,53 @@ cprReqDLCNames = {'dlc/dlc002.dlc': 'Mongol Face Pack',
                   'dlc/dlc065.dlc': 'South Indian Portraits'}
 
 
-# Determine whether the DLCs required for CPR are installed in the active game folder.
-# Returns None if DLC detection (game folder detection) fails, an empty list if all
-# requirements are met, and otherwise the exact list of the missing DLCs' names.
-def detectCPRMissingDLCs():
-    # Normalize path keys denormReqDLCNames, platform-specific (varies even between cygwin and win32)
-    reqDLCNames = {os.path.normpath(f): cprReqDLCNames[f] for f in cprReqDLCNames.keys()}
+# Results of the Steam game folder & DLC scan are kept between runs in this file, because resolving the Steam master
+# folder and probing every external library can take seconds on machines with several (slow) library drives. The
+# cache is only trusted while both the mtime of the Steam master library DB (libraryfolders.vdf) and the mtime of the
+# game's dlc/ folder are unchanged, as any relevant library move or DLC (un)installation changes at least one of them.
+g_steamCacheFilename = 'HIP_steam_cache.json'
+
+
+def getSteamLibraryDBMTime(masterFolder):
+    dbPath = os.path.join(masterFolder, 'libraryfolders.vdf')
+    return os.path.getmtime(dbPath) if os.path.exists(dbPath) else None
+
+
+def loadSteamCache():
+    g_dbg.push('load_steam_cache("{}")'.format(g_steamCacheFilename))
+    try:
+        with open(g_steamCacheFilename, 'r') as f:
+            cache = json.load(f)
+        if getSteamLibraryDBMTime(cache['masterFolder']) != cache['libraryDBMTime']:
+            g_dbg.pop('steam_cache(STALE: libraryfolders.vdf)')
+            return None
+        if os.path.getmtime(os.path.join(cache['gameFolder'], 'dlc')) != cache['dlcFolderMTime']:
+            g_dbg.pop('steam_cache(STALE: dlc)')
+            return None
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        g_dbg.pop('steam_cache(NOT_FOUND)')
+        return None
+    g_dbg.pop('steam_cache(VALID)')
+    return cache
+
 
+def saveSteamCache(masterFolder, gameFolder, dlcFiles):
+    g_dbg.trace('save_steam_cache("{}")'.format(g_steamCacheFilename))
+    cache = {'masterFolder':   masterFolder,
+             'gameFolder':     gameFolder,
+             'libraryDBMTime': getSteamLibraryDBMTime(masterFolder),
+             'dlcFolderMTime': os.path.getmtime(os.path.join(gameFolder, 'dlc')),
+             'dlcFiles':       dlcFiles}
+    try:
+        with open(g_steamCacheFilename, 'w') as f:
+            json.dump(cache, f, indent=1)
+    except IOError:
+        g_dbg.trace('save_steam_cache(FAILED)')  # Merely a missed optimization for the next run
+
+
+# Scan for the active game folder and list its installed DLC files (as 'dlc/<file>' paths). Returns None if the game
+# folder cannot be found.
+def scanSteamDLCs():
     masterFolder = getSteamMasterFolder()
     if not masterFolder:
         return None
@@ -819,7 +1654,29 @@ def detectCPRMissingDLCs():
     if not os.path.isdir(dlcFolder):
         return None
 
-    for f in [os.path.join('dlc', e) for e in os.listdir(dlcFolder)]:
+    dlcFiles = [os.path.join('dlc', e) for e in os.listdir(dlcFolder)]
+    saveSteamCache(masterFolder, gameFolder, dlcFiles)
+    return dlcFiles
+
+
+# Determine whether the DLCs required for CPR are installed in the active game folder.
+# Returns None if DLC detection (game folder detection) fails, an empty list if all
+# requirements are met, and otherwise the exact list of the missing DLCs' names.
+def detectCPRMissingDLCs():
+    # Normalize path keys denormReqDLCNames, platform-specific (varies even between cygwin and win32)
+    reqDLCNames = {os.path.normpath(f): cprReqDLCNames[f] for f in cprReqDLCNames.keys()}
+
+    cache = loadSteamCache()
+
+    if cache:
+        g_dbg.trace('game_folder("{}")'.format(cache['gameFolder']))
+        dlcFiles = cache['dlcFiles']
+    else:
+        dlcFiles = scanSteamDLCs()
+        if dlcFiles is None:
+            return None
+
+    for f in dlcFiles:
         if f in reqDLCNames:
             del reqDLCNames[f]
 
@@ -834,9 +1691,12 @@ def printCPRReqDLCNames():
     sys.stdout.write('\n')
 
 
-def scaffoldMod(baseFolder, targetFolder, modBasename, modName, modPath, modUserDir=None, eu4Version=None):
-    # Remove preexisting target folder...
-    if os.path.exists(targetFolder):
+def scaffoldMod(baseFolder, targetFolder, modBasename, modName, modPath, modUserDir=None, eu4Version=None,
+                keepTarget=False):
+    # Remove preexisting target folder (unless it's to be resumed)...
+    if keepTarget and os.path.isdir(targetFolder):
+        g_dbg.trace('keep_preexisting_mod("{}")'.format(targetFolder))
+    elif os.path.exists(targetFolder):
 
         if not g_steamMode:
             sys.stdout.write('\n')
@@ -849,7 +1709,8 @@ def scaffoldMod(baseFolder, targetFolder, modBasename, modName, modPath, modUser
         print(u'> Removed (%0.1f sec).\n' % (endTime - startTime))
         sys.stdout.flush()
 
-    mkTree(targetFolder)
+    if not os.path.isdir(targetFolder):
+        mkTree(targetFolder)
 
     modFilename = modBasename + '.mod'
 
@@ -878,22 +1739,486 @@ def scaffoldMod(baseFolder, targetFolder, modBasename, modName, modPath, modUser
     return modFilename
 
 
+# Flags of the module selection, as used by mergeModules()
+g_moduleFlags = ['EMF', 'ARKOCoA', 'ARKOInt', 'ArumbaKS', 'CPR', 'CPRfaces', 'VIETevents', 'VIETtraits', 'SWMH',
+                 'uSWMH', 'SED', 'NBRT']
+
+
+def scaffoldTarget(sel, targetFolder, keepTarget=False):
+    VIET = sel['VIETtraits'] or sel['VIETevents']
+
+    if targetFolder != g_defaultFolder:
+        modBasename = 'HIP_' + targetFolder
+    else:
+        modBasename = 'HIP'
+
+    if sel['EMF'] or sel['ARKOCoA'] or sel['ARKOInt'] or sel['CPR'] or VIET or sel['SWMH']:
+        modUserDir = modBasename
+    else:
+        modUserDir = None
+
+#    if Converter:
+#        euModFilename = scaffoldMod(euFolderBase,
+#                                    euFolder,
+#                                    'HIP_Converter',
+#                                    'HIP Converter Support',
+#                                    euSubfolder,
+#                                    eu4Version='1.10')
+
+    return scaffoldMod('.',
+                       targetFolder,
+                       modBasename,
+                       'HIP - ' + targetFolder,
+                       targetFolder,
+                       modUserDir,
+                       keepTarget=keepTarget)
+
+
+# Resolve the overlay of module folders for a module selection (a dict which maps each of g_moduleFlags to whether
+# that module is selected) into g_targetSrc, and return the lines of the mod's version.txt.
+def mergeModules(sel, targetFolder):
+    EMF = sel['EMF']
+    ARKOCoA = sel['ARKOCoA']
+    ARKOInt = sel['ARKOInt']
+    ArumbaKS = sel['ArumbaKS']
+    CPR = sel['CPR']
+    CPRfaces = sel['CPRfaces']
+    VIETevents = sel['VIETevents']
+    VIETtraits = sel['VIETtraits']
+    SWMH = sel['SWMH']
+    uSWMH = sel['uSWMH']
+    SED = sel['SED']
+    NBRT = sel['NBRT']
+
+    VIET = (VIETtraits or VIETevents)
+    HIP = VIETevents  # HIP_Common (Isis, e_hip, our event picture stash, etc.)
+    # Converter = EMF and not SWMH  # Vanilla EUIV Converter
+
+    euFolderBase = '../eu4_export/mod'
+    euSubfolder = 'HIP_Converter'
+    euFolder = euFolderBase + '/' + euSubfolder
+
+    global g_targetSrc
+    g_targetSrc = {}
+
+    moduleOutput = ["[HIP Release %s]\n" % g_versions['pkg']]
+    g_dbg.push('merge_all')
+
+    if EMF:
+        moduleOutput.append("EMF: Extended Mechanics & Flavor (%s)\n" % g_versions['EMF'])
+
+    if ArumbaKS:
+        g_dbg.push('merge(ArumbaKS)')
+        moduleOutput.append("Arumba's Keyboard Shortcuts (%s)\n" % g_versions['ArumbaKS'])
+        pushFolder('ArumbaKS', targetFolder)
+        g_dbg.pop()
+
+    if ARKOInt:
+        g_dbg.push("merge('ARKO Interface')")
+        moduleOutput.append("ARKO Interface (%s)\n" % g_versions['ARKOI'])
+        pushFolder("ARKOpack_Interface", targetFolder)
+        if ArumbaKS:
+            pushFolder('ArkoInterface+AKS', targetFolder)
+        if HIP:
+            popTree('gfx/event_pictures', targetFolder)
+        g_dbg.pop()
+
+    if VIET:
+        pushFolder("VIET_Assets", targetFolder)
+
+    if HIP:
+        pushFolder("HIP_Common", targetFolder)
+
+    if SWMH:
+        g_dbg.push("merge(SWMH)")
+        moduleOutput.append("SWMH (%s)\n" % g_versions['SWMH'])
+        pushFolder("SWMH", targetFolder)
+        if ARKOInt:
+            pushFolder("SWMH+ArkoInterface", targetFolder)
+            if ArumbaKS:
+                pushFolder("SWMH+ArkoInterface+AKS", targetFolder)
+        elif ArumbaKS:
+            pushFolder("SWMH+AKS", targetFolder)
+        g_dbg.pop()
+
+    if uSWMH:
+        g_dbg.push("merge(uSWMH)")
+        moduleOutput.append("MiniSWMH: Performance-Friendly SWMH (%s)\n" % g_versions['uSWMH'])
+        pushFolder("MiniSWMH", targetFolder)
+        g_dbg.pop()
+
+    if SED:
+        g_dbg.push("merge(SED)")
+        moduleOutput.append("SED: English Localisation for SWMH (%s)\n" % g_versions['SED'])
+        pushFolder("SED2", targetFolder)
+        if EMF:
+            pushFolder("SED2+EMF", targetFolder)
+        if VIET:
+            pushFolder("SED2+VIET", targetFolder)
+        if uSWMH:
+            pushFolder("SED2+MiniSWMH", targetFolder)
+        g_dbg.pop()
+
+    if ARKOCoA:
+        g_dbg.push("merge('ARKO CoA')")
+        moduleOutput.append("ARKO Armoiries (%s)\n" % g_versions['ARKOC'])
+        pushFolder("ARKOpack_Armoiries", targetFolder)
+        g_dbg.pop()
+
+    if NBRT:
+        g_dbg.push("merge(NBRT)")
+        moduleOutput.append("NBRT+ (%s)\n" % g_versions['NBRT'])
+        pushFolder("NBRT+", targetFolder)
+        if SWMH and (g_platform == 'win' or g_platform == 'cyg') and False:  # Disabled for SWMH EE testing
+            pushFolder("NBRT+SWMH", targetFolder)
+        if ARKOCoA:
+            pushFolder("NBRT+ARKO", targetFolder)
+        if not SWMH or True:  # Enabled for SWMH EE testing
+            popFile('gfx/FX/pdxmap.fxh', targetFolder)  # Z: 2.2 compatch for NBRT+ Light (and Mac/Linux compatch)
+        g_dbg.pop()
+
+    if VIETtraits:
+        g_dbg.push("merge('VIET Traits')")
+        moduleOutput.append("VIET Traits (%s)\n" % g_versions['VIET'])
+        pushFolder("VIET_Traits", targetFolder)
+        g_dbg.pop()
+
+    if VIETevents:
+        g_dbg.push("merge('VIET Events')")
+        moduleOutput.append("VIET Events (%s)\n" % g_versions['VIET'])
+        pushFolder("VIET_Events", targetFolder)
+        g_dbg.pop()
+
+    if EMF:
+        g_dbg.push('merge(EMF)')
+        pushFolder('EMF', targetFolder)
+
+        if SWMH:
+            pushFolder('EMF+SWMH', targetFolder)
+            if uSWMH:
+                pushFolder('EMF+MiniSWMH', targetFolder)
+        else:
+            pushFolder('EMF+Vanilla', targetFolder)
+
+        if ARKOInt:
+            pushFolder("EMF+ArkoInterface", targetFolder)
+
+        g_dbg.pop()
+
+    if CPR:
+        g_dbg.push('merge(CPR)')
+        moduleOutput.append("CPRplus (%s)\n" % g_versions['CPR'])
+
+        wrappedPaths = set(['gfx'])
+        pushFolder('CPRplus', targetFolder, wrapPaths=wrappedPaths)
+
+        if CPRfaces:
+            pushFolder('CPRplus-compatch/CustomFaces', targetFolder)
+
+        if SWMH:
+            pushFolder('CPRplus-compatch/SWMH', targetFolder)
+        elif EMF:
+            pushFolder('CPRplus-compatch/EMF', targetFolder)
+
+        g_dbg.pop()
+
+#    if Converter:
+#        pushFolder("Converter/Vanilla", targetFolder)
+#        pushFolder("Converter/Extra", euFolder)
+
+    resolveOverlay()
+
+    g_dbg.pop("merge_done")
+
+    return moduleOutput
+
+
+def writeVersionFile(targetFolder, moduleOutput):
+    versionFilename = os.path.join(targetFolder, "version.txt")
+    with openGeneratedFile(versionFilename) as output:
+        output.write("".join(moduleOutput))
+    return versionFilename
+
+
+# Warm installer service (--serve[=<port or Unix socket path>]) for launchers and provisioning scripts, which would
+# otherwise start a new installer process (that rescans modules/) for every action. The service keeps the package index
+# (the scanned module folders and their versions) and every resolved plan in memory, so repeated requests skip startup
+# and scanning entirely. A request is a JSON object on a line of its own:
+#
+#   {"op": "plan" | "install" | "verify", "modules": [<names from g_moduleFlags>], "target": "<mod folder>"}
+#   {"op": "version"}
+#   {"op": "rescan"}  (after modules/ changed underneath the service)
+#
+# The modules must form a selection which the interactive installer could make (e.g., no MiniSWMH without SWMH), and
+# "verify" compares the content of every installed file against the package.
+#
+# Each request is answered with a stream of JSON event lines: {"event": "progress", "text": ...} for each line of the
+# usual installer output, and then either {"event": "done", "result": {...}} or {"event": "error", "message": ...}. A
+# connection may carry any number of requests, but they are served one at a time, as the installer's state is global.
+# A port number only binds to localhost. Files are always copied rather than moved, as the package must outlive every
+# request.
+g_servePort = 8497
+g_planCache = {}  # (selected modules, target folder) => (g_targetSrc, moduleOutput)
+
+
+class ServiceEventWriter:
+    def __init__(self, f):
+        self.file = f
+        self.buf = u''
+
+    def write(self, s):  # Stands in for sys.stdout, turning each line of output into a progress event
+        if isinstance(s, str):
+            s = s.decode('cp1252', 'replace')
+        lines = (self.buf + s).split(u'\n')
+        self.buf = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.event('progress', text=line)
+
+    def flush(self):
+        pass
+
+    def event(self, name, **fields):
+        fields['event'] = name
+        self.file.write(json.dumps(fields) + '\n')
+        self.file.flush()
+
+
+# The combinations which the interactive selection in main() never offers, as mergeModules() would make a broken mod
+# out of them (e.g., MiniSWMH on top of the vanilla map)
+def getSelectionErrors(sel):
+    errors = []
+    for module, dependency in (('uSWMH', 'SWMH'), ('SED', 'SWMH'), ('CPRfaces', 'CPR')):
+        if sel[module] and not sel[dependency]:
+            errors.append('{} requires {}'.format(module, dependency))
+    if sel['VIETtraits'] and sel['EMF']:
+        errors.append('VIETtraits conflicts with EMF')
+    return errors
+
+
+def getRequestSelection(req):
+    modules = req.get('modules', [])
+    unknown = [m for m in modules if m not in g_moduleFlags]
+    if unknown:
+        raise InstallerServiceError('unknown modules: {}'.format(', '.join(unknown)))
+    sel = {x: x in modules for x in g_moduleFlags}
+    errors = getSelectionErrors(sel)
+    if errors:
+        raise InstallerServiceError('invalid module selection: {}'.format('; '.join(errors)))
+
+    targetFolder = req.get('target', g_defaultFolder).encode('utf-8')
+    if not targetFolder or targetFolder.startswith('.') or os.path.basename(targetFolder) != targetFolder:
+        raise InstallerServiceError("invalid target folder '{}'".format(targetFolder))
+    return sel, targetFolder
+
+
+# Make the plan for a module selection current in g_targetSrc, resolving it only if it isn't already cached
+def loadPlan(sel, targetFolder):
+    global g_targetSrc
+    key = (tuple(x for x in g_moduleFlags if sel[x]), targetFolder)
+    cached = key in g_planCache
+    g_dbg.trace('plan_cache({})'.format('HIT' if cached else 'MISS'))
+    if not cached:
+        moduleOutput = mergeModules(sel, targetFolder)
+        g_planCache[key] = (g_targetSrc, moduleOutput)
+    g_targetSrc, moduleOutput = g_planCache[key]
+    return moduleOutput, cached
+
+
+def getPackageFileSize(path):
+    if g_archive:
+        return g_archiveIndex[os.path.normpath(path)].file_size
+    return os.path.getsize(path)
+
+
+# SHA-1 of a package file's content as compileFile() installs it, i.e., unwrapped
+def getPackageFileSHA1(src):
+    with openPackageFile(src.srcPath) as f:
+        if src.wrap == WRAP_NONE:
+            return hashFileObj(hashlib.sha1(), f).hexdigest()
+        buf = bytearray(f.read())
+    unwrapData(buf, quickMode=(src.wrap == WRAP_QUICK))
+    return hashlib.sha1(buf).hexdigest()
+
+
+# Compare an installed mod against the current plan: its version.txt, its file-to-module map, and the presence & content
+# of every compiled file (size first, as unwrapping never changes a file's size, then SHA-1 against the package file as
+# it'd be installed; version.txt is rewritten by the installer, so it's left to the version check). Returns the list of
+# problems found.
+def verifyTarget(targetFolder, moduleOutput):
+    mapFilename = os.path.join(targetFolder, "file2mod_map.txt")
+    versionFilename = os.path.join(targetFolder, "version.txt")
+    if not (os.path.exists(mapFilename) and os.path.exists(versionFilename)):
+        return ['not installed']
+
+    problems = []
+
+    with open(versionFilename, 'r') as f:
+        if f.read() != ''.join(moduleOutput):
+            problems.append('version.txt: package release or module selection differs')
+
+    installed = readFile2ModMap(mapFilename)
+    planned = {stripPathHead(p): g_targetSrc[p].folder for p in g_targetSrc}
+    for path in sorted(set(installed) | set(planned)):
+        if installed.get(path) != planned.get(path):
+            problems.append('file2mod_map.txt: {} <= [{}] (expected [{}])'.format(path, installed.get(path, ''),
+                                                                                   planned.get(path, '')))
+
+    for dstPath in sorted(g_targetSrc):
+        src = g_targetSrc[dstPath]
+        if src.isDir:
+            if not os.path.isdir(dstPath):
+                problems.append('missing folder: {}'.format(dstPath))
+        elif not os.path.isfile(dstPath):
+            problems.append('missing file: {}'.format(dstPath))
+        elif dstPath == versionFilename:
+            continue
+        elif os.path.getsize(dstPath) != getPackageFileSize(src.srcPath):
+            problems.append('wrong size: {}'.format(dstPath))
+        elif hashFile(hashlib.sha1(), dstPath).hexdigest() != getPackageFileSHA1(src):
+            problems.append('wrong content: {}'.format(dstPath))
+
+    return problems
+
+
+def serveRequest(req, modDirs):
+    op = req.get('op')
+
+    if op == 'version':
+        return {'installer': g_version['Version'], 'modules': g_versions}
+
+    if op == 'rescan':
+        g_scanTree.clear()
+        g_scanInodes.clear()
+        g_planCache.clear()
+        getPkgVersions(modDirs)
+        return {'modules': g_versions}
+
+    if op not in ('plan', 'install', 'verify'):
+        raise InstallerServiceError("unknown op '{}'".format(op))
+
+    sel, targetFolder = getRequestSelection(req)
+    moduleOutput, cached = loadPlan(sel, targetFolder)
+    result = {'target': targetFolder, 'num_files': sum(1 for x in g_targetSrc.itervalues() if not x.isDir)}
+
+    if op == 'plan':
+        result['modules'] = [x.rstrip('\n') for x in moduleOutput]
+        result['plan_id'] = getPlanID(sorted(g_targetSrc))
+        result['cached'] = cached
+
+    elif op == 'install':
+        oldCacheDigest, oldCacheHashes = readCacheDigest(targetFolder)
+        g_compiledHashes.clear()
+        scaffoldTarget(sel, targetFolder, keepTarget=g_resumeMode)
+        startTime = time.time()
+        compileTarget(os.path.join(targetFolder, "file2mod_map.txt"))
+        endTime = time.time()
+        print(u'> Compiled (%0.1f sec).\n' % (endTime - startTime))
+        writeVersionFile(targetFolder, moduleOutput)
+        resetCaches(targetFolder, oldCacheDigest, oldCacheHashes)
+        result['seconds'] = round(endTime - startTime, 1)
+
+    else:
+        problems = verifyTarget(targetFolder, moduleOutput)
+        result['ok'] = not problems
+        result['num_problems'] = len(problems)
+        result['problems'] = problems[:100]
+
+    return result
+
+
+def handleServiceRequest(line, events, modDirs):
+    savedStdout = sys.stdout
+    sys.stdout = events
+    g_dbg.push('service_request')
+    try:
+        try:
+            req = json.loads(line)
+        except ValueError:
+            raise InstallerServiceError('malformed request (expected a JSON object per line)')
+        if not isinstance(req, dict):
+            raise InstallerServiceError('malformed request (expected a JSON object per line)')
+        g_dbg.trace('op({})'.format(req.get('op')))
+        events.event('done', result=serveRequest(req, modDirs))
+    except InstallerException as e:
+        del g_overlayOps[:]
+        events.event('error', message=str(e))
+    except Exception:
+        del g_overlayOps[:]
+        events.event('error', message=traceback.format_exc())
+    finally:
+        sys.stdout = savedStdout
+        g_dbg.pop()
+
+
+def serve(address, modDirs):
+    global g_language
+    global g_move
+    global g_linkFarm
+    g_language = 'en'
+    g_move = False
+    g_linkFarm = getLinkFarmMode() if (g_linkFarmMode and not g_archive) else None
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in iter(self.rfile.readline, ''):
+                if line.strip():
+                    handleServiceRequest(line, ServiceEventWriter(self.wfile), modDirs)
+
+    if address.isdigit():
+        server = SocketServer.TCPServer(('127.0.0.1', int(address)), Handler)
+    elif hasattr(SocketServer, 'UnixStreamServer'):
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)  # Left behind by a previous service
+        server = SocketServer.UnixStreamServer(address, Handler)
+    else:
+        raise InstallerServiceError('Unix sockets are not supported here, so use a port number')
+
+    g_dbg.trace('serve("{}")'.format(address))
+    print(u'Serving installer requests on {} (Ctrl-C to stop) ...'.format(address))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if not address.isdigit():
+            rmFile(address)
+
+
 def main():
     # noinspection PyBroadException
     try:
-        initLocalisation()
         initVersionEnvInfo()
 
         # Not really sure if these even need to be global anymore...
         global g_dbgMode
         global g_steamMode
         global g_zijiMode
+        global g_moveMode
+        global g_unwrapCache
+        global g_linkFarmMode
+        global g_resumeMode
+        global g_updateMode
+        global g_startupTimeMode
 
         g_dbgMode = '-D' in sys.argv[1:] or '--debug' in sys.argv[1:]
+        g_startupTimeMode = '--startup-time' in sys.argv[1:]
         versionMode = '-V' in sys.argv[1:] or '--version' in sys.argv[1:]
         inplaceMode = '--in-place' in sys.argv[1:]
         g_steamMode = '--steam' in sys.argv[1:]
         g_zijiMode = '-Z' in sys.argv[1:]
+        g_moveMode = '--move' in sys.argv[1:]
+        unwrapCacheMode = '--unwrap-cache' in sys.argv[1:]
+        g_linkFarmMode = '--link-farm' in sys.argv[1:]
+        g_resumeMode = '--resume' in sys.argv[1:]
+        updateModule = getArgValue('--update')
+        g_updateMode = updateModule is not None
+        if g_updateMode:
+            checkUpdateModule(updateModule)
+        archivePath = getArgValue('--package')
+        serveAddress = getArgValue('--serve')
+        if serveAddress is None and '--serve' in sys.argv[1:]:
+            serveAddress = str(g_servePort)
         zijiSelect = '-z' in sys.argv[1:]
         swmhSelect = '--swmh' in sys.argv[1:]
         sedSelect = '--sed' in sys.argv[1:]
@@ -923,12 +2248,21 @@ def main():
         # anywhere on the system but still be able to assume the relative path to,
         # e.g., "modules/" is just that.
 
+        if archivePath:
+            archivePath = os.path.abspath(archivePath)  # Relative to the original working directory
+
         if not inplaceMode:
             normalizeCwd()
 
-        if not os.path.isdir('modules'):
+        rollbackMoveJournal()
+
+        if archivePath:
+            openArchive(archivePath)
+        elif not os.path.isdir('modules'):
             raise InstallerPackageNotFoundError()
 
+        g_unwrapCache = UnwrapCache(g_unwrapCacheFolder, g_unwrapCacheMaxBytes) if unwrapCacheMode else None
+
         # These are the modules/ directories from which to grab each mod's version.txt:
         modDirs = {'pkg': '',  # Installer package version
                    'VIET':     'VIET_Assets',
@@ -945,6 +2279,10 @@ def main():
 
         getPkgVersions(modDirs)
 
+        if serveAddress:
+            serve(serveAddress, modDirs)
+            return 0
+
         # Prompt user for options related to this install
         targetFolder = getInstallOptions()
 
@@ -1063,171 +2401,21 @@ def main():
             else:
                 NBRT = False if g_steamMode else enableModDefaultNo(u"NBRT+ ({})".format(g_versions['NBRT']))
 
-        VIET = (VIETtraits or VIETevents)
-        HIP = VIETevents  # HIP_Common (Isis, e_hip, our event picture stash, etc.)
-        # Converter = EMF and not SWMH  # Vanilla EUIV Converter
-
-        euFolderBase = '../eu4_export/mod'
-        euSubfolder = 'HIP_Converter'
-        euFolder = euFolderBase + '/' + euSubfolder
+        sel = {'EMF': EMF, 'ARKOCoA': ARKOCoA, 'ARKOInt': ARKOInt, 'ArumbaKS': ArumbaKS, 'CPR': CPR,
+               'CPRfaces': CPRfaces, 'VIETevents': VIETevents, 'VIETtraits': VIETtraits, 'SWMH': SWMH,
+               'uSWMH': uSWMH, 'SED': SED, 'NBRT': NBRT}
 
         # Prepare for installation...
-
-        if targetFolder != g_defaultFolder:
-            modBasename = 'HIP_' + targetFolder
-        else:
-            modBasename = 'HIP'
-
-        if EMF or ARKOCoA or ARKOInt or CPR or VIET or SWMH:
-            modUserDir = modBasename
-        else:
-            modUserDir = None
-
-        modFilename = scaffoldMod('.',
-                                  targetFolder,
-                                  modBasename,
-                                  'HIP - ' + targetFolder,
-                                  targetFolder,
-                                  modUserDir)
-
-#        if Converter:
-#            euModFilename = scaffoldMod(euFolderBase,
-#                                        euFolder,
-#                                        'HIP_Converter',
-#                                        'HIP Converter Support',
-#                                        euSubfolder,
-#                                        eu4Version='1.10')
+        oldCacheDigest, oldCacheHashes = readCacheDigest(targetFolder)
 
         # Prepare file mappings...
-        global g_targetSrc
-        g_targetSrc = {}
-
-        moduleOutput = ["[HIP Release %s]\n" % g_versions['pkg']]
-        g_dbg.push('merge_all')
-
-        if EMF:
-            moduleOutput.append("EMF: Extended Mechanics & Flavor (%s)\n" % g_versions['EMF'])
-
-        if ArumbaKS:
-            g_dbg.push('merge(ArumbaKS)')
-            moduleOutput.append("Arumba's Keyboard Shortcuts (%s)\n" % g_versions['ArumbaKS'])
-            pushFolder('ArumbaKS', targetFolder)
-            g_dbg.pop()
-
-        if ARKOInt:
-            g_dbg.push("merge('ARKO Interface')")
-            moduleOutput.append("ARKO Interface (%s)\n" % g_versions['ARKOI'])
-            pushFolder("ARKOpack_Interface", targetFolder)
-            if ArumbaKS:
-                pushFolder('ArkoInterface+AKS', targetFolder)
-            if HIP:
-                popTree('gfx/event_pictures', targetFolder)
-            g_dbg.pop()
-
-        if VIET:
-            pushFolder("VIET_Assets", targetFolder)
-
-        if HIP:
-            pushFolder("HIP_Common", targetFolder)
-
-        if SWMH:
-            g_dbg.push("merge(SWMH)")
-            moduleOutput.append("SWMH (%s)\n" % g_versions['SWMH'])
-            pushFolder("SWMH", targetFolder)
-            if ARKOInt:
-                pushFolder("SWMH+ArkoInterface", targetFolder)
-                if ArumbaKS:
-                    pushFolder("SWMH+ArkoInterface+AKS", targetFolder)
-            elif ArumbaKS:
-                pushFolder("SWMH+AKS", targetFolder)
-            g_dbg.pop()
-
-        if uSWMH:
-            g_dbg.push("merge(uSWMH)")
-            moduleOutput.append("MiniSWMH: Performance-Friendly SWMH (%s)\n" % g_versions['uSWMH'])
-            pushFolder("MiniSWMH", targetFolder)
-            g_dbg.pop()
-
-        if SED:
-            g_dbg.push("merge(SED)")
-            moduleOutput.append("SED: English Localisation for SWMH (%s)\n" % g_versions['SED'])
-            pushFolder("SED2", targetFolder)
-            if EMF:
-                pushFolder("SED2+EMF", targetFolder)
-            if VIET:
-                pushFolder("SED2+VIET", targetFolder)
-            if uSWMH:
-                pushFolder("SED2+MiniSWMH", targetFolder)
-            g_dbg.pop()
-
-        if ARKOCoA:
-            g_dbg.push("merge('ARKO CoA')")
-            moduleOutput.append("ARKO Armoiries (%s)\n" % g_versions['ARKOC'])
-            pushFolder("ARKOpack_Armoiries", targetFolder)
-            g_dbg.pop()
-
-        if NBRT:
-            g_dbg.push("merge(NBRT)")
-            moduleOutput.append("NBRT+ (%s)\n" % g_versions['NBRT'])
-            pushFolder("NBRT+", targetFolder)
-            if SWMH and (g_platform == 'win' or g_platform == 'cyg') and False:  # Disabled for SWMH EE testing
-                pushFolder("NBRT+SWMH", targetFolder)
-            if ARKOCoA:
-                pushFolder("NBRT+ARKO", targetFolder)
-            if not SWMH or True:  # Enabled for SWMH EE testing
-                popFile('gfx/FX/pdxmap.fxh', targetFolder)  # Z: 2.2 compatch for NBRT+ Light (and Mac/Linux compatch)
-            g_dbg.pop()
-
-        if VIETtraits:
-            g_dbg.push("merge('VIET Traits')")
-            moduleOutput.append("VIET Traits (%s)\n" % g_versions['VIET'])
-            pushFolder("VIET_Traits", targetFolder)
-            g_dbg.pop()
-
-        if VIETevents:
-            g_dbg.push("merge('VIET Events')")
-            moduleOutput.append("VIET Events (%s)\n" % g_versions['VIET'])
-            pushFolder("VIET_Events", targetFolder)
-            g_dbg.pop()
-
-        if EMF:
-            g_dbg.push('merge(EMF)')
-            pushFolder('EMF', targetFolder)
-
-            if SWMH:
-                pushFolder('EMF+SWMH', targetFolder)
-                if uSWMH:
-                    pushFolder('EMF+MiniSWMH', targetFolder)
-            else:
-                pushFolder('EMF+Vanilla', targetFolder)
+        moduleOutput = mergeModules(sel, targetFolder)
 
-            if ARKOInt:
-                pushFolder("EMF+ArkoInterface", targetFolder)
+        # Refuse an update before anything is touched, so that the installation is left as it was
+        if updateModule:
+            checkUpdatable(targetFolder, moduleOutput)
 
-            g_dbg.pop()
-
-        if CPR:
-            g_dbg.push('merge(CPR)')
-            moduleOutput.append("CPRplus (%s)\n" % g_versions['CPR'])
-
-            wrappedPaths = set(['gfx'])
-            pushFolder('CPRplus', targetFolder, wrapPaths=wrappedPaths)
-
-            if CPRfaces:
-                pushFolder('CPRplus-compatch/CustomFaces', targetFolder)
-
-            if SWMH:
-                pushFolder('CPRplus-compatch/SWMH', targetFolder)
-            elif EMF:
-                pushFolder('CPRplus-compatch/EMF', targetFolder)
-
-            g_dbg.pop()
-
-#        if Converter:
-#            pushFolder("Converter/Vanilla", targetFolder)
-#            pushFolder("Converter/Extra", euFolder)
-
-        g_dbg.pop("merge_done")
+        scaffoldTarget(sel, targetFolder, keepTarget=g_resumeMode or g_updateMode)
 
         # Where to dump a mapping of all the compiled files to their source modules (will include stuff from outside
         # targetFolder for now too if such stuff is pushed on to the virtual filesystem)
@@ -1236,9 +2424,13 @@ def main():
         startTime = time.time()
 
         # do all the actual compilation (file I/O)
-        compileTarget(mapFilename)
+        if updateModule:
+            updateTarget(mapFilename, updateModule)
+        else:
+            compileTarget(mapFilename)
 
         if g_move:
+            rmFile(g_moveJournalFilename)
             rmTree("modules")  # Cleanup
 
         endTime = time.time()
@@ -1249,17 +2441,14 @@ def main():
             print(unicode(mapFilename + '\n'))
 
         # Dump modules selected and their respective g_versions to <mod>/version.txt
-        versionFilename = os.path.join(targetFolder, "version.txt")
-
-        with open(versionFilename, "w") as output:
-            output.write("".join(moduleOutput))
+        versionFilename = writeVersionFile(targetFolder, moduleOutput)
 
         print(u"Summary of mod combination & versions (INCLUDE THIS FILE IN BUG REPORTS):")
         print(unicode(versionFilename + "\n"))
 
         # Reset all gfx/map/interface/logs cache for every instance of a preexisting
-        # user_dir that includes HIP, platform-agnostic.
-        resetCaches()
+        # user_dir that includes HIP, platform-agnostic (unless gfx/ and map/ are unchanged).
+        resetCaches(targetFolder, oldCacheDigest, oldCacheHashes)
 
         # Installation complete
         g_dbg.trace("install_done")
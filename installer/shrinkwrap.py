@@ -2,13 +2,26 @@
 
 import os
 import sys
+import mmap
 import time
+import hashlib
 import argparse
+import multiprocessing
+
+import main as installer  # For the package wrapping codec, which is shared with the installer
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # Optional backport for Python 2
+    except ImportError:
+        scandir = None
 
 default_module_folder = '/cygdrive/d/ck/mod/modules'
 shrinkwrap_sentinel_file = 'no_shrinkwrap.txt'
-k = bytearray(br'"The enemy of a good plan is the dream of a perfect plan" - Carl von Clausewitz')
-header_len = 1 << 12
+shrinkwrap_manifest_file = 'shrinkwrap_manifest.txt'
+header_len = installer.g_wrapHeaderLen
 banned_file_ext = ['.pdn', '.psd', '.xcf', '.bak', '.tmp', '.rar', '.zip', \
                   '.7z', '.gz', '.tgz', '.xz', '.bz2', '.tar', '.ignore', \
                   '.xls', '.xlsx', '.xlsm', '.db']
@@ -26,24 +39,349 @@ def is_binary(path):
     return extension.lower() in ['.dds', '.tga']
 
 
-def encrypt(buf, length):
-    kN = len(k)
-    for i in xrange(length):
-        buf[i] ^= k[i % kN]
+# Wrapping is the very same XOR as the installer's unwrapping
+encrypt = installer.unwrapBuffer
 
 
+# Both encrypt_file() and encrypt_file_in_place() return the SHA-1 of the wrapped file, hashed from the data they
+# already have in hand, so that it never needs to be read back.
 def encrypt_file(path, header_only=False):
     tmp_path = path + '.tmp'
     with open(path, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
-        length = os.path.getsize(path)
-        buf = bytearray(length)
+        buf = bytearray(os.path.getsize(path))
         fsrc.readinto(buf)
-        if header_only:
-            length = min(header_len, length)
-        encrypt(buf, length)
+        installer.unwrapData(buf, quickMode=header_only)
         fdst.write(buf)
     os.unlink(path)
     os.rename(tmp_path, path)
+    return hashlib.sha1(buf).hexdigest()
+
+
+# In-place mode (--in-place) transforms each file where it sits through a memory map, so only the bytes which change are
+# written (just the header of a .dds/.tga) and no temporary copy is needed. So that a file is never left half-encrypted,
+# the original bytes of each chunk are appended to the file's journal (<file>.swjournal) and synced before the chunk is
+# encrypted, and the journal is only removed once the whole file has been synced. After a crash, recover_journal()
+# restores the chunk which was in flight and decrypts the chunks before it (XOR is its own inverse), which returns the
+# file to plaintext.
+journal_ext = '.swjournal'
+chunk_len = 1 << 20
+
+
+def encrypt_chunk(mm, offset, length):  # -> the encrypted bytes
+    buf = bytearray(mm[offset:offset + length])
+    encrypt(buf, length, offset)
+    data = bytes(buf)
+    mm[offset:offset + length] = data
+    return data
+
+
+def append_journal(journal, offset, original):
+    journal.write('{} {} {}\n'.format(offset, len(original), hashlib.sha1(original).hexdigest()))
+    journal.write(original)
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def encrypt_file_in_place(path, header_only=False):
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+    length = min(header_len, size) if header_only else size
+    if length == 0:
+        return h.hexdigest()
+    journal_path = path + journal_ext
+    with open(path, 'r+b') as f, open(journal_path, 'wb') as journal:
+        mm = mmap.mmap(f.fileno(), 0)
+        try:
+            for offset in xrange(0, length, chunk_len):
+                n = min(chunk_len, length - offset)
+                append_journal(journal, offset, mm[offset:offset + n])
+                h.update(encrypt_chunk(mm, offset, n))
+                mm.flush()
+            for offset in xrange(length, size, chunk_len):  # The rest of a .dds/.tga, left as it was
+                h.update(mm[offset:offset + chunk_len])
+        finally:
+            mm.close()
+    os.unlink(journal_path)
+    return h.hexdigest()
+
+
+# Returns the path of the recovered file. A journal's final record may be torn, but then its chunk was never touched,
+# and restoring the last intact record is still correct, as that chunk was completely encrypted.
+def recover_journal(journal_path):
+    path = journal_path[:-len(journal_ext)]
+    last = None
+    with open(journal_path, 'rb') as journal:
+        while True:
+            fields = journal.readline().split()
+            if len(fields) != 3 or not (fields[0].isdigit() and fields[1].isdigit()):
+                break
+            original = journal.read(int(fields[1]))
+            if hashlib.sha1(original).hexdigest() != fields[2]:
+                break
+            last = (int(fields[0]), original)
+
+    if last and os.path.exists(path):
+        offset, original = last
+        with open(path, 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), 0)
+            try:
+                mm[offset:offset + len(original)] = original
+                for o in xrange(0, offset, chunk_len):
+                    encrypt_chunk(mm, o, min(chunk_len, offset - o))
+                mm.flush()
+            finally:
+                mm.close()
+
+    os.unlink(journal_path)
+    return path
+
+
+def encrypt_task(task):
+    path, header_only, in_place = task
+    start_time = time.time()
+    if in_place:
+        sha1 = encrypt_file_in_place(path, header_only)
+    else:
+        sha1 = encrypt_file(path, header_only)
+    return path, time.time() - start_time, sha1
+
+
+# Calls on_result(func(task)) for every task, in completion order, in a pool of jobs worker processes if jobs > 1. Once
+# anything fails, the tasks which no worker has started yet are skipped, so that an in-place run never goes on wrapping
+# files which would then not be recorded as wrapped. The pool is closed & joined rather than terminated, which could
+# hang on a worker that is still sending its result.
+def run_tasks(func, tasks, jobs, on_result):
+    if jobs <= 1:
+        for task in tasks:
+            on_result(func(task))
+        return
+    abort = multiprocessing.Event()
+    pool = multiprocessing.Pool(jobs, init_worker, (abort,))
+    try:
+        for result in pool.imap_unordered(run_worker_task, [(func, task) for task in tasks]):
+            on_result(result)
+    finally:
+        abort.set()
+        pool.close()
+        pool.join()
+
+
+def init_worker(abort):
+    global g_abort
+    g_abort = abort
+
+
+def run_worker_task(task):
+    func, task = task
+    return None if g_abort.is_set() else func(task)
+
+
+# Files are encrypted independently of each other, so with --jobs > 1 they're spread over worker processes (the XOR loop
+# holds the GIL, so they can't be threads). The largest files are handed out first so that no worker is left with a big
+# one at the end. Any failure in a worker is raised here, before the caller records any file as wrapped. Takes (path,
+# size) pairs, and returns the (path, seconds, wrapped SHA-1) of every file.
+def encrypt_files(files, jobs, in_place=False):
+    tasks = [(p, is_binary(p), in_place) for p, _ in sorted(files, key=lambda f: f[1], reverse=True)]
+    timings = []
+    x = len(tasks) // 20
+
+    def on_result(result):
+        path, seconds, sha1 = result
+        timings.append(result)
+        n = len(timings)
+        if args.verbose > 1:
+            print("encrypted file: '{}' ({:0.2f}sec)".format(path, seconds))
+        elif x and n % x == 0 and n < len(tasks):
+            print('shrinkwrap: {}% ({}/{} files)'.format(n // x * 5, n, len(tasks)))
+            sys.stdout.flush()
+
+    run_tasks(encrypt_task, tasks, jobs, on_result)
+    return timings
+
+
+def print_timing_summary(timings, n_slowest=5):
+    if not timings:
+        return
+    total = sum(t[1] for t in timings)
+    print('shrinkwrap files: %d (%0.2fsec total, %0.1fms mean per file)' %
+          (len(timings), total, total / len(timings) * 1000))
+    for path, seconds, _ in sorted(timings, key=lambda x: x[1], reverse=True)[:n_slowest]:
+        print('  %0.2fsec  %s' % (seconds, os.path.relpath(path, module_folder)))
+
+
+# Shrinkwrap state is kept per file in modules/shrinkwrap_manifest.txt (outside of any module, so it's never installed):
+# one line per file under CPRplus/gfx with its plaintext SHA-1, its wrapped SHA-1, its wrap mode, and its path relative
+# to modules/. A rerun only encrypts the files which are new or whose content changed, and drops the entries of files
+# which are gone. The files queued for encryption are recorded (with a wrapped SHA-1 of '-') before any of them is
+# touched, so that a rerun after an interrupted one can tell which of them were already wrapped.
+#
+# As XOR is its own inverse, wrapping an already-wrapped file would silently turn it back into plaintext. So a new or
+# changed file which already looks wrapped (it has the wrapped content of a recorded file, or a format check says so)
+# is reported as an error instead of being encrypted.
+#
+# A tree without a manifest still goes by the old no_shrinkwrap.txt sentinel once: with the sentinel, the tree is all
+# plaintext, and without it, the tree was completely shrinkwrapped, so its manifest is built by decoding every file.
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def decoded_sha1(path, header_only):
+    with open(path, 'rb') as f:
+        buf = bytearray(f.read())
+    installer.unwrapData(buf, quickMode=header_only)
+    return hashlib.sha1(buf).hexdigest()
+
+
+def is_text(buf):
+    return all(c >= 0x20 or c in (0x09, 0x0a, 0x0d) for c in buf)
+
+
+def looks_wrapped(path, header_only):
+    with open(path, 'rb') as f:
+        head = bytearray(f.read(64))
+    decoded = bytearray(head)
+    encrypt(decoded, len(decoded))
+    if path.lower().endswith('.dds'):
+        return not head.startswith(b'DDS ') and decoded.startswith(b'DDS ')
+    if header_only:  # No magic number to go by in a .tga
+        return False
+    return is_text(decoded) and not is_text(head)
+
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        return None
+    manifest = {}
+    with open(path, 'r') as f:
+        for line in f:
+            entry = line.rstrip('\r\n').split(' ', 3)
+            if len(entry) == 4:
+                manifest[entry[3]] = tuple(entry[:3])
+    return manifest
+
+
+def write_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for rel in sorted(manifest):
+            f.write('{} {} {} {}\n'.format(manifest[rel][0], manifest[rel][1], manifest[rel][2], rel))
+    if os.name == 'nt' and os.path.exists(path):  # No atomic replacing rename on Windows under Python 2
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+# Bring the shrinkwrapped files (given as (path, size) pairs) & the manifest up to date. Returns the encryption timings
+# and the paths of the files which were refused because they look wrapped already.
+def update_shrinkwrap(files, manifest_path, sentinel_path):
+    manifest = read_manifest(manifest_path)
+    adopt = False
+    if manifest is None:
+        manifest = {}
+        adopt = not os.path.exists(sentinel_path)
+        if adopt:
+            print('shrinkwrap: no manifest and no sentinel, so recording the files as already shrinkwrapped')
+    wrapped_index = set(e[1] for e in manifest.itervalues())
+
+    new_manifest = {}
+    queue = []
+    refused = []
+
+    for path, size in files:
+        rel = os.path.relpath(path, module_folder).replace(os.sep, '/')
+        header_only = is_binary(path)
+        mode = 'quick' if header_only else 'total'
+        sha1 = file_sha1(path)
+        e = manifest.get(rel)
+        if e and e[2] != mode:
+            e = None
+
+        if adopt:
+            new_manifest[rel] = (decoded_sha1(path, header_only), sha1, mode)
+        elif e and sha1 == e[1]:
+            new_manifest[rel] = e
+        elif e and e[1] == '-' and decoded_sha1(path, header_only) == e[0]:
+            new_manifest[rel] = (e[0], sha1, mode)  # Wrapped by an interrupted run
+        elif (e and sha1 == e[0]) or not (sha1 in wrapped_index or looks_wrapped(path, header_only)):
+            new_manifest[rel] = (sha1, '-', mode)
+            queue.append((path, size))
+        else:
+            refused.append(rel)
+
+    n_dropped = len(set(manifest) - set(new_manifest))
+    write_manifest(manifest_path, new_manifest)
+
+    timings = encrypt_files(queue, args.jobs, args.in_place)
+    for path, _, sha1 in timings:
+        rel = os.path.relpath(path, module_folder).replace(os.sep, '/')
+        new_manifest[rel] = (new_manifest[rel][0], sha1, new_manifest[rel][2])
+    write_manifest(manifest_path, new_manifest)
+
+    if os.path.exists(sentinel_path):
+        os.unlink(sentinel_path)
+
+    print('shrinkwrap: %d files (%d up to date, %d encrypted, %d refused, %d dropped from the manifest)' %
+          (len(files), len(files) - len(queue) - len(refused), len(queue), len(refused), n_dropped))
+    return timings, refused
+
+
+# Yields the (path, size) of every file under top. os.scandir() (or the scandir backport for Python 2, if it's
+# available) classifies directory entries without a stat() call each on most platforms, and on Windows, its entries
+# even come with the file sizes.
+def scan_files(top):
+    if scandir is None:
+        for root, dirs, files in os.walk(top):
+            for f in files:
+                path = os.path.join(root, f)
+                yield path, os.path.getsize(path)
+        return
+    stack = [top]
+    while stack:
+        for e in scandir(stack.pop()):
+            if e.is_dir():
+                stack.append(e.path)
+            else:
+                yield e.path, e.stat().st_size
+
+
+def get_module(path):
+    parts = os.path.relpath(path, module_folder).split(os.sep)
+    return parts[0] if len(parts) > 1 else '/'
+
+
+def print_removal_report(removed):
+    print('would remove:')
+    for module in sorted(removed):
+        files = sorted(removed[module])
+        print("  '%s': %d files (%0.2fMB)" % (module, len(files), sum(x[1] for x in files) / 1000.0 / 1000))
+        for path, size in files:
+            print("    %s (%dKB)" % (os.path.relpath(path, module_folder), size // 1000))
+
+
+# Round-trip verification (--verify) decodes every shrinkwrapped file with the installer's own codec, in parallel with
+# --jobs, and checks it against the plaintext SHA-1 recorded in the manifest. Any mismatch fails the build. Only the
+# wrapped header of a .dds/.tga needs decoding, so this costs little more than reading the files.
+def verify_task(task):
+    path, plain_sha1, header_only = task
+    return path, os.path.isfile(path) and decoded_sha1(path, header_only) == plain_sha1
+
+
+def verify_shrinkwrap(manifest_path, jobs):
+    start_time = time.time()
+    manifest = read_manifest(manifest_path) or {}
+    tasks = [(os.path.join(module_folder, os.path.normpath(rel)), e[0], e[2] == 'quick')
+             for rel, e in sorted(manifest.iteritems())]
+    results = []
+    run_tasks(verify_task, tasks, jobs, results.append)
+    bad = sorted(path for path, ok in results if not ok)
+    print('verify: %d files, %d mismatches (%0.2fsec)' % (len(tasks), len(bad), time.time() - start_time))
+    return [os.path.relpath(path, module_folder) for path in bad]
 
 
 def get_args():
@@ -51,49 +389,70 @@ def get_args():
         description="Prepare a HIP modules/ folder for build (remove unwanted files & shrinkwrap).")
     parser.add_argument('--modules-dir', default=default_module_folder,
                         help='path to modules/ folder for build')
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help='only report (by module) what would be removed; change nothing')
+    parser.add_argument('--in-place', action='store_true',
+                        help='encrypt files where they sit (journaled) rather than through temporary copies')
+    parser.add_argument('--verify', action='store_true',
+                        help="verify that every shrinkwrapped file decodes (with the installer's codec) to its "
+                             "recorded plaintext")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes for encryption [default: %(default)s]')
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help="show verbose information about what I'm doing")
     return parser.parse_args()
 
 
-args = get_args()
-module_folder = os.path.abspath(args.modules_dir)
-shrinkwrap_folder = os.path.join(module_folder, "CPRplus")
+def main():
+    global args, module_folder
+    args = get_args()
+    module_folder = os.path.abspath(args.modules_dir)
+    shrinkwrap_folder = os.path.join(module_folder, "CPRplus")
 
-# CPRplus only wants its gfx/ sub-folder encrypted so that power users can play with the portrait definitions
-real_shrinkwrap_folder = os.path.join(shrinkwrap_folder, 'gfx')
+    # CPRplus only wants its gfx/ sub-folder encrypted so that power users can play with the portrait definitions
+    real_shrinkwrap_folder = os.path.join(shrinkwrap_folder, 'gfx')
 
-if not os.path.exists(module_folder):
-    sys.stderr.write('invalid modules folder: {}\n'.format(module_folder))
-    sys.exit(1)
+    if not os.path.exists(module_folder):
+        sys.stderr.write('invalid modules folder: {}\n'.format(module_folder))
+        return 1
 
-if not os.path.exists(shrinkwrap_folder):
-    sys.stderr.write('invalid shrinkwrap folder: {}\n'.format(shrinkwrap_folder))
-    sys.exit(2)
+    if not os.path.exists(shrinkwrap_folder):
+        sys.stderr.write('invalid shrinkwrap folder: {}\n'.format(shrinkwrap_folder))
+        return 2
 
-if not os.path.exists(real_shrinkwrap_folder):
-    sys.stderr.write('invalid "real" shrinkwrap folder: {}\n'.format(real_shrinkwrap_folder))
-    sys.exit(3)
+    if not os.path.exists(real_shrinkwrap_folder):
+        sys.stderr.write('invalid "real" shrinkwrap folder: {}\n'.format(real_shrinkwrap_folder))
+        return 3
 
-n_removed_files = 0
-n_removed_bytes = 0
-n_files = 0
-n_bytes = 0
+    n_removed_files = 0
+    n_removed_bytes = 0
+    n_files = 0
+    n_bytes = 0
+    removed = {}  # Module => [(path, size)] of the files removed (or to be removed, if it's a dry run)
+    journals = []  # Leftovers of interrupted in-place encryption
+    shrinkwrap_files = []
 
-# Clear unwanted files from full distribution
+    # A single pass over the full distribution clears unwanted files, counts the rest, and collects the files to
+    # shrinkwrap along with their sizes
 
-for root, dirs, files in os.walk(module_folder):
-    for i in files:
-        path = os.path.join(root, i)
-        if path.endswith(shrinkwrap_sentinel_file):
-            continue  # will get removed at end
+    gfx_prefix = os.path.join(real_shrinkwrap_folder, '')
+
+    for path, size in scan_files(module_folder):
+        if path.endswith(shrinkwrap_sentinel_file) or path.endswith(shrinkwrap_manifest_file):
+            continue  # Build state, not package content
+        elif path.endswith(journal_ext):
+            journals.append(path)
         elif is_wanted(path):
             n_files += 1
-            n_bytes += os.path.getsize(path)
+            n_bytes += size
+            if path.startswith(gfx_prefix):
+                shrinkwrap_files.append((path, size))
         else:
-            size = os.path.getsize(path)
             n_removed_files += 1
             n_removed_bytes += size
+            removed.setdefault(get_module(path), []).append((path, size))
+            if args.dry_run:
+                continue
             os.unlink(path)
             if args.verbose > 0:
                 head, f = os.path.split(path)
@@ -102,29 +461,54 @@ for root, dirs, files in os.walk(module_folder):
                     d = '/'
                 print("removed file: '{}' ({}KB) in '{}'".format(f, size // 1000, d))
 
-removed_MB = n_removed_bytes / 1000 / 1000
-final_MB = n_bytes / 1000 / 1000
+    removed_MB = n_removed_bytes / 1000 / 1000
+    final_MB = n_bytes / 1000 / 1000
+
+    if args.dry_run:
+        for path in journals:
+            print("would recover interrupted encryption: '{}'".format(path[:-len(journal_ext)]))
+        if removed:
+            print_removal_report(removed)
+        print('final package:   %d files (%dMB)' % (n_files, final_MB))
+        print('\n> would remove %d unwanted files (%0.2fMB)' % (n_removed_files, removed_MB))
+        return 0
 
-# Now, onward to encryption of real_shrinkwrap_folder...
+    # Finish off (by rolling back) any in-place encryption which was interrupted
+    for path in journals:
+        print("recovered interrupted encryption: '{}'".format(recover_journal(path)))
 
-# We will check for the encryption sentinel first
-sentinel_path = os.path.join(shrinkwrap_folder, shrinkwrap_sentinel_file)
+    # Now, onward to encryption of real_shrinkwrap_folder...
+
+    sentinel_path = os.path.join(shrinkwrap_folder, shrinkwrap_sentinel_file)
+    manifest_path = os.path.join(module_folder, shrinkwrap_manifest_file)
 
-if not os.path.exists(sentinel_path):
-    sys.stderr.write('already shrinkwrapped: {}\n'.format(shrinkwrap_folder))
-else:
     start_wrap_time = time.time()
-    for root, dirs, files in os.walk(real_shrinkwrap_folder):
-        for i in files:
-            path = os.path.join(root, i)
-            encrypt_file(path, header_only=is_binary(path))
+    timings, refused = update_shrinkwrap(shrinkwrap_files, manifest_path, sentinel_path)
     end_wrap_time = time.time()
-    os.unlink(sentinel_path)
-    print("shrinkwrap time: %0.2fsec" % (end_wrap_time - start_wrap_time))
+    print("shrinkwrap time: %0.2fsec (jobs: %d)" % (end_wrap_time - start_wrap_time, max(1, args.jobs)))
+    print_timing_summary(timings)
+
+    mismatches = verify_shrinkwrap(manifest_path, args.jobs) if args.verify else []
+
+    print('final package:   %d files (%dMB)' % (n_files, final_MB))
+
+    if n_removed_files > 0:
+        print('\n> removed %d unwanted files (%0.2fMB)' % (n_removed_files, removed_MB))
+
+    if refused:
+        sys.stderr.write('\nrefusing to encrypt files which look shrinkwrapped already (which would decrypt them):\n')
+        for rel in refused:
+            sys.stderr.write('  {}\n'.format(rel))
+        return 4
+
+    if mismatches:
+        sys.stderr.write('\nshrinkwrapped files which do not decode to their recorded plaintext:\n')
+        for rel in mismatches:
+            sys.stderr.write('  {}\n'.format(rel))
+        return 5
 
-print('final package:   %d files (%dMB)' % (n_files, final_MB))
+    return 0
 
-if n_removed_files > 0:
-    print('\n> removed %d unwanted files (%0.2fMB)' % (n_removed_files, removed_MB))
 
-sys.exit(0)
+if __name__ == '__main__':
+    sys.exit(main())
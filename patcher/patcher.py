@@ -0,0 +1,377 @@
+#!/usr/bin/python
+
+# patcher  --  create & apply binary delta patches between two releases of a HIP file tree
+#
+# A patch describes how to turn one directory tree (normally a release's modules/ folder, but an installed mod folder
+# works just as well) into another: which files were added, removed, or changed. Changed files which are large enough
+# are described as a sequence of blocks which are either copied from the old file or stored literally in the patch,
+# so that updating an install only costs the changed bytes. Every file touched by a patch is verified against its
+# SHA-1 before it is patched and after it is rewritten, and nothing at all is modified unless the whole target tree
+# verifies against the patch first.
+#
+# A patch is a single zip archive holding manifest.json and the literal data which it references under data/.
+
+import os
+import sys
+import zlib
+import json
+import hashlib
+import zipfile
+import argparse
+import traceback
+
+PATCH_FORMAT = 1
+MANIFEST_NAME = 'manifest.json'
+TMP_SUFFIX = '.patch-tmp'
+default_block_size = 1 << 16
+default_min_delta_size = 1 << 20
+read_size = 1 << 20
+max_literal_size = 1 << 20
+
+
+class PatchError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return str(self.msg)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Create or apply a binary delta patch between two releases of a HIP modules/ (or mod) folder.')
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+                        help="show verbose information about what I'm doing")
+    subparsers = parser.add_subparsers(dest='command')
+
+    create = subparsers.add_parser('create', help='create a patch from OLD_DIR to NEW_DIR')
+    create.add_argument('old_dir', metavar='OLD_DIR', help='folder of the old release')
+    create.add_argument('new_dir', metavar='NEW_DIR', help='folder of the new release')
+    create.add_argument('patch_file', metavar='PATCH_FILE', help='patch file to create')
+    create.add_argument('--block-size', type=int, default=default_block_size,
+                        help='block size used for block-level binary diffs [default: %(default)s]')
+    create.add_argument('--min-delta-size', type=int, default=default_min_delta_size,
+                        help='changed files smaller than this are stored whole [default: %(default)s]')
+
+    apply_ = subparsers.add_parser('apply', help='apply PATCH_FILE to TARGET_DIR in-place')
+    apply_.add_argument('patch_file', metavar='PATCH_FILE', help='patch file to apply')
+    apply_.add_argument('target_dir', metavar='TARGET_DIR', help='folder to patch (must match the old release)')
+    apply_.add_argument('--dry-run', '-n', action='store_true',
+                        help='only verify that the patch applies cleanly; change nothing')
+    return parser.parse_args()
+
+
+def log(msg, level=1):
+    if args.verbose >= level:
+        print(msg)
+
+
+def to_native(rel_path):
+    return os.path.join(*rel_path.split('/'))
+
+
+def list_tree(base):
+    files = set()
+    for root, dirs, filenames in os.walk(base):
+        for f in filenames:
+            rel = os.path.relpath(os.path.join(root, f), base)
+            files.add(rel.replace(os.sep, '/'))
+    return files
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Index the old file's blocks rsync-style: by a weak checksum (Adler-32), which can be rolled along the new file a byte
+# at a time, mapping to the SHA-1 and offset of each block with that checksum. The final partial block, if any, is
+# returned separately as (offset, length, SHA-1), as it can only match the very end of the new file.
+def block_index(path, block_size):
+    index = {}
+    tail = None
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            if len(block) < block_size:
+                tail = (offset, len(block), hashlib.sha1(block).digest())
+            else:
+                index.setdefault(zlib.adler32(block) & 0xffffffff, {}).setdefault(hashlib.sha1(block).digest(), offset)
+            offset += len(block)
+    return index, tail
+
+
+# Describe new_path in terms of ops: ['c', offset, length] copies bytes from the old file, and ['l', member] inserts
+# the content of a literal data member of the patch. Adjacent copies are coalesced, and literal data is split into
+# members of at most max_literal_size bytes.
+#
+# Old blocks are found at any offset in the new file, so that content which merely shifted (e.g., after an insertion)
+# is still copied: the weak checksum of the block-sized window is rolled forward a byte at a time while nothing
+# matches, and only a weak match is confirmed by SHA-1. After a match, the scan skips ahead by a whole block.
+#
+# The new file is streamed through buf, which only holds the pending literal data followed by the current window (and
+# whatever has been read ahead of it), so memory use doesn't grow with the size of the file.
+def diff_blocks(old_path, new_path, block_size, add_literal):
+    index, tail = block_index(old_path, block_size)
+    ops = []
+
+    def add_copy(offset, length):
+        if ops and ops[-1][0] == 'c' and ops[-1][1] + ops[-1][2] == offset:
+            ops[-1][2] += length
+        else:
+            ops.append(['c', offset, length])
+
+    def flush_literal(length):
+        ops.append(['l', add_literal(str(buf[:length]))])
+        del buf[:length]
+
+    buf = bytearray()  # Pending literal data (buf[:i]), then the window at i
+    i = 0
+    weak = None
+    eof = False
+    with open(new_path, 'rb') as f:
+        while True:
+            if len(buf) <= i + block_size and not eof:  # Also needs the byte after the window, to roll it
+                chunk = f.read(read_size)
+                buf.extend(chunk)
+                eof = not chunk
+                continue
+            if len(buf) < i + block_size:
+                break
+            if weak is None:
+                weak = zlib.adler32(buffer(buf, i, block_size)) & 0xffffffff
+                a, b = weak & 0xffff, weak >> 16
+            stop = min(len(buf) - block_size, max_literal_size)
+            while weak not in index and i < stop:  # Roll the window forward by a byte (Adler-32 sums are modulo 65521)
+                out = buf[i]
+                a = (a - out + buf[i + block_size]) % 65521
+                b = (b - block_size * out + a - 1) % 65521
+                weak = (b << 16) | a
+                i += 1
+            if weak in index:
+                offset = index[weak].get(hashlib.sha1(buffer(buf, i, block_size)).digest())
+                if offset is not None:
+                    if i:
+                        flush_literal(i)
+                    add_copy(offset, block_size)
+                    del buf[:block_size]
+                    i = 0
+                    weak = None
+                    continue
+            if i < len(buf) - block_size:  # No match here, so move on by a byte
+                out = buf[i]
+                a = (a - out + buf[i + block_size]) % 65521
+                b = (b - block_size * out + a - 1) % 65521
+                weak = (b << 16) | a
+                i += 1
+            elif eof:  # This was the last window
+                break
+            if i >= max_literal_size:
+                flush_literal(i)
+                i = 0
+
+    n = len(buf)
+    if tail and n >= tail[1] and hashlib.sha1(buffer(buf, n - tail[1])).digest() == tail[2]:
+        if n > tail[1]:
+            flush_literal(n - tail[1])
+        add_copy(tail[0], tail[1])
+    elif n:
+        flush_literal(n)
+    return ops
+
+
+def create_patch(old_dir, new_dir, patch_file, block_size, min_delta_size):
+    old_files = list_tree(old_dir)
+    new_files = list_tree(new_dir)
+    manifest = {'format': PATCH_FORMAT, 'added': [], 'removed': [], 'changed': []}
+    n_literal = [0, 0]  # Number of literal data members & their total bytes
+
+    with zipfile.ZipFile(patch_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+
+        def add_literal(data):
+            member = 'data/{}'.format(n_literal[0])
+            z.writestr(member, data)
+            n_literal[0] += 1
+            n_literal[1] += len(data)
+            return member
+
+        def add_file(path):  # Streamed into the patch, rather than read into memory whole like add_literal's data
+            member = 'data/{}'.format(n_literal[0])
+            z.write(path, member)
+            n_literal[0] += 1
+            n_literal[1] += os.path.getsize(path)
+            return member
+
+        for rel in sorted(old_files - new_files):
+            log("removed: '{}'".format(rel))
+            manifest['removed'].append({'path': rel, 'sha1': file_sha1(os.path.join(old_dir, to_native(rel)))})
+
+        for rel in sorted(new_files - old_files):
+            log("added: '{}'".format(rel))
+            new_path = os.path.join(new_dir, to_native(rel))
+            manifest['added'].append({'path': rel, 'sha1': file_sha1(new_path), 'ops': [['l', add_file(new_path)]]})
+
+        for rel in sorted(old_files & new_files):
+            old_path = os.path.join(old_dir, to_native(rel))
+            new_path = os.path.join(new_dir, to_native(rel))
+            old_sha1 = file_sha1(old_path)
+            new_sha1 = file_sha1(new_path)
+            if old_sha1 == new_sha1:
+                continue
+            if os.path.getsize(new_path) < min_delta_size:
+                ops = [['l', add_file(new_path)]]
+            else:
+                ops = diff_blocks(old_path, new_path, block_size, add_literal)
+            log("changed: '{}' ({} ops)".format(rel, len(ops)))
+            manifest['changed'].append({'path': rel, 'old_sha1': old_sha1, 'sha1': new_sha1, 'ops': ops})
+
+        z.writestr(MANIFEST_NAME, json.dumps(manifest, indent=1, sort_keys=True))
+
+    print('patch: {} added, {} removed, {} changed ({}KB literal data)'.format(
+        len(manifest['added']), len(manifest['removed']), len(manifest['changed']), n_literal[1] // 1000))
+
+
+def load_manifest(z):
+    manifest = json.loads(z.read(MANIFEST_NAME).decode('utf-8'))
+    if manifest.get('format') != PATCH_FORMAT:
+        raise PatchError('unsupported patch format: {}'.format(manifest.get('format')))
+    return manifest
+
+
+# Returns the list of (kind, entry) pairs which still need to be applied. Entries whose file is already in its patched
+# state are skipped, so that re-applying an interrupted patch simply finishes the job.
+def verify_target(manifest, target_dir):
+    todo = []
+    errors = []
+
+    for e in manifest['removed']:
+        path = os.path.join(target_dir, to_native(e['path']))
+        if not os.path.exists(path):
+            continue
+        if file_sha1(path) != e['sha1']:
+            errors.append("modified file slated for removal: '{}'".format(e['path']))
+        todo.append(('removed', e))
+
+    for e in manifest['added']:
+        path = os.path.join(target_dir, to_native(e['path']))
+        if os.path.exists(path):
+            if file_sha1(path) != e['sha1']:
+                errors.append("unexpected preexisting file: '{}'".format(e['path']))
+            continue
+        todo.append(('added', e))
+
+    for e in manifest['changed']:
+        path = os.path.join(target_dir, to_native(e['path']))
+        if not os.path.exists(path):
+            errors.append("missing file: '{}'".format(e['path']))
+            continue
+        sha1 = file_sha1(path)
+        if sha1 == e['sha1']:
+            continue
+        if sha1 != e['old_sha1']:
+            errors.append("file does not match the patch's old release: '{}'".format(e['path']))
+        todo.append(('changed', e))
+
+    if errors:
+        raise PatchError('target folder does not match the patch:\n  ' + '\n  '.join(errors))
+
+    return todo
+
+
+def replace_file(src, dst):
+    if os.name == 'nt' and os.path.exists(dst):  # No atomic replacing rename on Windows under Python 2
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def build_file(z, e, old_path, dst_path):
+    h = hashlib.sha1()
+    with open(dst_path, 'wb') as fdst:
+        fold = open(old_path, 'rb') if old_path else None
+        try:
+            for op in e['ops']:
+                if op[0] == 'c':
+                    fold.seek(op[1])
+                    data = fold.read(op[2])
+                else:
+                    data = z.read(op[1])
+                h.update(data)
+                fdst.write(data)
+        finally:
+            if fold:
+                fold.close()
+    if h.hexdigest() != e['sha1']:
+        os.remove(dst_path)
+        raise PatchError("patched file failed verification: '{}'".format(e['path']))
+
+
+def apply_patch(patch_file, target_dir, dry_run):
+    with zipfile.ZipFile(patch_file, 'r') as z:
+        manifest = load_manifest(z)
+        todo = verify_target(manifest, target_dir)
+
+        if dry_run:
+            print('patch applies cleanly ({} files to update)'.format(len(todo)))
+            return
+
+        for kind, e in todo:
+            path = os.path.join(target_dir, to_native(e['path']))
+            log("{}: '{}'".format(kind, e['path']))
+
+            if kind == 'removed':
+                os.remove(path)
+                d = os.path.dirname(os.path.abspath(path))  # Both sides absolute, so the walk up stops at the target
+                while d != os.path.abspath(target_dir) and not os.listdir(d):
+                    os.rmdir(d)
+                    d = os.path.dirname(d)
+                continue
+
+            d = os.path.dirname(path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+            tmp_path = path + TMP_SUFFIX
+            build_file(z, e, path if kind == 'changed' else None, tmp_path)
+            replace_file(tmp_path, path)
+
+    print('patch applied ({} files updated)'.format(len(todo)))
+
+
+def main():
+    global args
+    args = get_args()
+    try:
+        if args.command == 'create':
+            for d in (args.old_dir, args.new_dir):
+                if not os.path.isdir(d):
+                    sys.stderr.write('invalid folder: {}\n'.format(d))
+                    return 1
+            create_patch(args.old_dir, args.new_dir, args.patch_file, args.block_size, args.min_delta_size)
+        else:
+            if not os.path.isdir(args.target_dir):
+                sys.stderr.write('invalid target folder: {}\n'.format(args.target_dir))
+                return 1
+            apply_patch(args.patch_file, args.target_dir, args.dry_run)
+        return 0
+
+    except PatchError as e:
+        sys.stderr.write('\nPatch error: ' + str(e) + '\n')
+        return 2
+
+    except:
+        sys.stderr.write('\nUnexpected fatal error occurred! Stack trace:\n\n')
+        traceback.print_exc(file=sys.stderr)
+        return 255
+
+
+if __name__ == '__main__':
+    sys.exit(main())